@@ -1,8 +1,11 @@
-from agents import Agent, Runner, FunctionTool, RunContextWrapper
+from agents import Agent, AgentsException, Runner, FunctionTool, RunContextWrapper
 from pydantic import BaseModel
+from dataclasses import asdict, dataclass
 from typing import Any
-from openai import OpenAI
+from openai import AsyncOpenAI
+import threading
 import asyncio
+import time
 
 '''
 Project Analysis
@@ -118,7 +121,40 @@ CRITICAL NOTE
 These bash commands will be executed directly in a git repository to resolve software engineering issues. 
 The solution must be completely functional and safe to execute. Avoid any explanatory text or comments."""
 
-critique_client = OpenAI()
+critique_client = AsyncOpenAI()
+
+AGENT_MODEL = "o4-mini-2025-04-16"
+CRITIQUE_MODEL = "gpt-5-mini-2025-08-07"
+
+# USD per 1M tokens, override per run through the prices field of the solver config
+PRICES = {
+    AGENT_MODEL: {"input": 1.1, "output": 4.4},
+    CRITIQUE_MODEL: {"input": 0.25, "output": 2.0},
+}
+
+# one event loop for the life of the process, so queries reuse the same loop and client connections
+agent_loop = None
+agent_loop_lock = threading.Lock()
+
+
+@dataclass
+class RunUsage:
+    agent_requests: int = 0
+    agent_input_tokens: int = 0
+    agent_output_tokens: int = 0
+    critique_cycles: int = 0
+    critique_input_tokens: int = 0
+    critique_output_tokens: int = 0
+    cost: float = 0.0
+    latency: float = 0.0
+
+
+def token_cost(model, input_tokens, output_tokens, prices):
+    price = prices.get(model)
+    if price is None:
+        print(f"No price for {model}, counting its cost as 0")
+        return 0.0
+    return (input_tokens * price["input"] + output_tokens * price["output"]) / 1_000_000
 
 
 class SelfCritiqueArgs(BaseModel):
@@ -150,8 +186,8 @@ async def self_critique(ctx: RunContextWrapper[Any], args: str) -> dict:
           f"\nPrev Score: {parsed.previous_critique_score}"
           )
 
-    response = critique_client.responses.parse(
-        model="gpt-5-mini-2025-08-07",
+    response = await critique_client.responses.parse(
+        model=CRITIQUE_MODEL,
         input=[
             {
                 "role": "system",
@@ -167,6 +203,13 @@ async def self_critique(ctx: RunContextWrapper[Any], args: str) -> dict:
         text_format=SelfCritiqueScore
     )
 
+    usage = ctx.context
+    if isinstance(usage, RunUsage):
+        usage.critique_cycles += 1
+        if response.usage is not None:
+            usage.critique_input_tokens += response.usage.input_tokens
+            usage.critique_output_tokens += response.usage.output_tokens
+
     score = response.output_parsed.model_dump()
     score_total = 0
     for sub_score in score:
@@ -238,19 +281,61 @@ self_critique_tool = FunctionTool(
 # Agent
 agent = Agent(
     name="Sage",
-    model="o4-mini-2025-04-16",
+    model=AGENT_MODEL,
     tools=[
         self_critique_tool,
     ]
 )
 
 
-async def response_gen(question):
-    result = await Runner.run(agent, question)
-    return result.final_output
+async def response_gen(question, prices=None, usage=None):
+    prices = PRICES | (prices or {})
+    usage = usage if usage is not None else RunUsage()
+    start = time.monotonic()
+    run_context = None
+    try:
+        # the usage object is the run context, so critique calls of concurrent runs are counted separately
+        result = await Runner.run(agent, question, context=usage)
+        run_context = result.context_wrapper
+        return result.final_output, usage
+    except AgentsException as e:
+        # failed runs (MaxTurnsExceeded is common on SWE-bench) carry the run so far, its calls were still billed
+        run_data = getattr(e, "run_data", None)
+        run_context = run_data.context_wrapper if run_data is not None else None
+        raise
+    finally:
+        usage.latency = time.monotonic() - start
+        if run_context is not None:
+            agent_usage = run_context.usage
+            usage.agent_requests = agent_usage.requests
+            usage.agent_input_tokens = agent_usage.input_tokens
+            usage.agent_output_tokens = agent_usage.output_tokens
+        usage.cost = token_cost(AGENT_MODEL, usage.agent_input_tokens, usage.agent_output_tokens, prices) + \
+            token_cost(CRITIQUE_MODEL, usage.critique_input_tokens, usage.critique_output_tokens, prices)
+
+
+def get_agent_loop():
+    global agent_loop
+    with agent_loop_lock:
+        if agent_loop is None:
+            agent_loop = asyncio.new_event_loop()
+            threading.Thread(target=agent_loop.run_forever, name="sage-agent-loop", daemon=True).start()
+    return agent_loop
+
+
+def new_response_with_usage(question, prices=None, usage=None):
+    # pass usage to keep what a failed query spent, it's filled in even when this raises
+    print("New Response Called")
+    usage = usage if usage is not None else RunUsage()
+    # safe to call from several threads at once, each query runs as a task on the shared loop
+    future = asyncio.run_coroutine_threadsafe(response_gen(question, prices, usage), get_agent_loop())
+    try:
+        answer, _ = future.result()
+    finally:
+        print(f"Usage: {asdict(usage)}")
+    return answer, usage
 
 
 def new_response(question):
-    print("New Response Called")
-    answer = asyncio.run(response_gen(question))
+    answer, _ = new_response_with_usage(question)
     return answer
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import subprocess
+import threading
+import argparse
+import json
+import time
+import os
+
+# Parallel, resumable SWE-bench runner for the critique engine
+# python -m RecursiveEvaluation.runner --workers 8 --processes 4 --output runs/verified (run from SageDebugger/)
+#
+# Every instance runs in its own mini-extra swebench-single process. --workers is the number of instances in flight,
+# --processes caps how many of those processes run at once (defaults to --workers). Inside each process the solver
+# reuses one event loop and client (see rec_agent.py).
+# Finished instances are checkpointed to results.jsonl and skipped when the same output directory is reused.
+
+MODEL_CLASS = "RecursiveEvaluation.solver.SageAgentModel"
+MODEL_NAME = "o4-mini-2025-04-16"
+
+checkpoint_lock = threading.Lock()
+
+
+def load_instance_ids(subset, split, instances_file):
+    if instances_file:
+        with open(instances_file) as f:
+            return [line.strip() for line in f if line.strip()]
+    from datasets import load_dataset
+    dataset = load_dataset("princeton-nlp/SWE-bench_{}".format(subset.capitalize()), split=split)
+    return [instance["instance_id"] for instance in dataset]
+
+
+def load_checkpoint(checkpoint_path):
+    finished = {}
+    if not checkpoint_path.exists():
+        return finished
+    with open(checkpoint_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            finished[record["instance_id"]] = record
+    return finished
+
+
+def save_checkpoint(checkpoint_path, record):
+    with checkpoint_lock:
+        with open(checkpoint_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def run_instance(instance_id, args, output_dir):
+    trajectory_path = output_dir / "trajectories" / "{}.traj.json".format(instance_id)
+    log_path = output_dir / "logs" / "{}.log".format(instance_id)
+    command = [
+        "mini-extra", "swebench-single",
+        "--subset", args.subset,
+        "--split", args.split,
+        "-i", instance_id,
+        "-m", args.model,
+        "--model-class", MODEL_CLASS,
+        "--exit-immediately",
+        "--yolo",
+        "-o", str(trajectory_path)
+    ]
+    # wall time starts once a process slot is free, so it doesn't include queueing behind other instances
+    with args.process_slots:
+        return run_process(instance_id, command, args.timeout, trajectory_path, log_path)
+
+
+def run_process(instance_id, command, timeout, trajectory_path, log_path):
+    start = time.monotonic()
+    try:
+        with open(log_path, "w") as log:
+            result = subprocess.run(
+                command,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                timeout=timeout,
+                cwd=Path(__file__).resolve().parent.parent
+            )
+        status = "done" if result.returncode == 0 else "failed"
+        returncode = result.returncode
+    except subprocess.TimeoutExpired:
+        status = "timeout"
+        returncode = None
+    return {
+        "instance_id": instance_id,
+        "status": status,
+        "returncode": returncode,
+        "wall_time": time.monotonic() - start,
+        "trajectory": str(trajectory_path),
+        "finished_at": time.time()
+    }
+
+
+def run(args):
+    output_dir = Path(args.output)
+    (output_dir / "trajectories").mkdir(parents=True, exist_ok=True)
+    (output_dir / "logs").mkdir(parents=True, exist_ok=True)
+    checkpoint_path = output_dir / "results.jsonl"
+
+    instance_ids = load_instance_ids(args.subset, args.split, args.instances)
+    finished = load_checkpoint(checkpoint_path)
+    skip_statuses = {"done"} if args.retry_failed else {"done", "failed", "timeout"}
+    pending = [i for i in instance_ids if i not in finished or finished[i]["status"] not in skip_statuses]
+    print("{} instances, {} already finished, {} to run".format(len(instance_ids), len(instance_ids) - len(pending),
+                                                                  len(pending)))
+
+    args.process_slots = threading.BoundedSemaphore(args.processes or args.workers)
+    run_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_instance, instance_id, args, output_dir): instance_id for instance_id in pending}
+        for completed, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            save_checkpoint(checkpoint_path, record)
+            print("[{}/{}] {} {} in {:.1f}s".format(completed, len(pending), record["instance_id"], record["status"],
+                                                    record["wall_time"]))
+    print("Finished in {:.1f}s".format(time.monotonic() - run_start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the critique engine on SWE-bench in parallel")
+    parser.add_argument("--subset", default="verified")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--instances", help="file with one instance id per line, defaults to the whole split")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--workers", type=int, default=4, help="instances in flight at once")
+    parser.add_argument("--processes", type=int, help="mini-extra processes running at once, defaults to --workers")
+    parser.add_argument("--timeout", type=int, default=60 * 60, help="seconds before an instance is killed")
+    parser.add_argument("--output", default="swebench_runs")
+    parser.add_argument("--retry-failed", action="store_true", help="also rerun failed and timed out instances")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
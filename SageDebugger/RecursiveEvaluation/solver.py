@@ -1,4 +1,4 @@
-from .rec_agent import new_response
+from .rec_agent import RunUsage, new_response_with_usage
 from dataclasses import asdict, dataclass, field
 from typing import Any
 
@@ -8,6 +8,8 @@ from typing import Any
 class SageConfig:
     model_name: str
     model_kwargs: dict[str, Any] = field(default_factory=dict)
+    # USD per 1M tokens by model name, merged over rec_agent.PRICES
+    prices: dict[str, dict[str, float]] = field(default_factory=dict)
 
 
 class SageAgentModel:
@@ -15,21 +17,43 @@ class SageAgentModel:
         self.config = SageConfig(**kwargs)
         self.cost = 0.0
         self.n_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.critique_cycles = 0
+        self.latency = 0.0
 
-    def _query(self, messages: list[dict[str, str]]):
+    def _query(self, messages: list[dict[str, str]], usage: RunUsage):
         print("_query running")
         try:
-            return new_response(messages)
+            return new_response_with_usage(messages, self.config.prices, usage)
         except Exception as e:
             raise e
 
+    def add_usage(self, usage: RunUsage):
+        self.n_calls += 1
+        self.cost += usage.cost
+        self.input_tokens += usage.agent_input_tokens + usage.critique_input_tokens
+        self.output_tokens += usage.agent_output_tokens + usage.critique_output_tokens
+        self.critique_cycles += usage.critique_cycles
+        self.latency += usage.latency
+
     def query(self, messages: list[dict[str, str]]) -> dict:
         print("query running")
-        response = self._query(messages)
+        usage = RunUsage()
+        try:
+            response, _ = self._query(messages, usage)
+        finally:
+            # queries that raise still spent tokens on the agent and critique calls
+            self.add_usage(usage)
         print("Response successful")
-        self.n_calls += 1
-        self.cost += 0.0
-        return {"content": response}
+        return {"content": response, "extra": {"usage": asdict(usage)}}
 
     def get_template_vars(self) -> dict[str, Any]:
-        return asdict(self.config) | {"n_model_calls": self.n_calls, "model_cost": self.cost}
+        return asdict(self.config) | {
+            "n_model_calls": self.n_calls,
+            "model_cost": self.cost,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "critique_cycles": self.critique_cycles,
+            "model_latency": self.latency
+        }
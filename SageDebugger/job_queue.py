@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+# persistent queue for batch debugging jobs, shared by every worker pointed at the same database file
+
+
+class JobQueue:
+    def __init__(self, path, stale_after=30 * 60):
+        self.path = path
+        self.stale_after = stale_after
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, batch_id TEXT, prompt TEXT, status TEXT, result TEXT, error TEXT, "
+            "created REAL, started REAL, finished REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        connection.commit()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def enqueue(self, prompts):
+        batch_id = uuid.uuid4().hex
+        job_ids = [uuid.uuid4().hex for _ in prompts]
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany(
+            "INSERT INTO jobs (id, batch_id, prompt, status, created) VALUES (?, ?, ?, 'queued', ?)",
+            [(job_id, batch_id, prompt, now) for job_id, prompt in zip(job_ids, prompts)]
+        )
+        connection.execute("COMMIT")
+        return batch_id, job_ids
+
+    def claim(self):
+        # BEGIN IMMEDIATE takes the write lock, so two workers can never claim the same job
+        connection = self.connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # jobs left running by a worker that died are picked up again
+            connection.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND started < ?",
+                (now - self.stale_after,)
+            )
+            row = connection.execute(
+                "SELECT id, prompt FROM jobs WHERE status = 'queued' ORDER BY created, rowid LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (now, row["id"]))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return (row["id"], row["prompt"]) if row is not None else None
+
+    def complete(self, job_id, result):
+        self.connection().execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id)
+        )
+
+    def fail(self, job_id, error):
+        self.connection().execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+            (error, time.time(), job_id)
+        )
+
+    def format_job(self, row):
+        return {
+            "job_id": row["id"],
+            "batch_id": row["batch_id"],
+            "status": row["status"],
+            "result": json.loads(row["result"]) if row["result"] is not None else None,
+            "error": row["error"],
+            "created": row["created"],
+            "started": row["started"],
+            "finished": row["finished"]
+        }
+
+    def get(self, job_id):
+        row = self.connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.format_job(row) if row is not None else None
+
+    def get_batch(self, batch_id):
+        rows = self.connection().execute(
+            "SELECT * FROM jobs WHERE batch_id = ? ORDER BY created, rowid", (batch_id,)
+        ).fetchall()
+        return [self.format_job(row) for row in rows]
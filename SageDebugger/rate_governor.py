@@ -0,0 +1,160 @@
+import contextvars
+import threading
+import random
+import json
+import time
+import os
+from shared_state import InProcessState
+
+# token bucket per upstream API, kept in shared_state so the limits hold across every worker using the same backend
+# interactive requests are served first, batch jobs can't drain the bucket below a reserve left for interactive ones
+# short pauses (backoff, Retry-After) are waited out, long ones (a daily quota) fail fast with QuotaExhausted
+# the stats and the interactive-first ordering are per worker process
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# set to BATCH by the batch workers, tasks and threads started from there inherit it
+traffic_priority = contextvars.ContextVar("traffic_priority", default=INTERACTIVE)
+
+# upstream: (requests per second, burst capacity), override with sage_rate_limits='{"openai": [2, 4]}'
+DEFAULT_LIMITS = {
+    "stackexchange": (10, 10),
+    "google_cse": (1, 5),
+    "web": (5, 10),
+    "openai": (5, 10),
+}
+
+
+class Throttled(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaExhausted(Throttled):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, upstream, rate, capacity, state, batch_reserve=0.2):
+        self.rate = rate
+        self.capacity = capacity
+        self.state = state
+        self.batch_reserve = batch_reserve
+        self.bucket_key = "rate_bucket:{}".format(upstream)
+        # wall clock time, since other workers read it too
+        self.pause_key = "rate_pause:{}".format(upstream)
+        self.interactive_waiting = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "failures": 0, "rejected": 0,
+                      "wait_seconds": 0.0}
+
+    def paused_for(self):
+        return max((self.state.get(self.pause_key) or 0) - time.time(), 0)
+
+    def acquire(self, priority, max_wait=None):
+        start = time.monotonic()
+        with self.condition:
+            self.waiting += 1
+            if priority == INTERACTIVE:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    needed = 1 + (self.capacity * self.batch_reserve if priority == BATCH else 0)
+                    wait = self.paused_for()
+                    if wait:
+                        # don't hold a worker thread (and any lock the caller has) for the rest of a long pause
+                        if max_wait is not None and wait > max_wait:
+                            self.stats["rejected"] += 1
+                            raise QuotaExhausted("Paused for another {:.0f}s".format(wait), wait)
+                    elif priority == BATCH and self.interactive_waiting:
+                        wait = 1 / self.rate
+                    else:
+                        wait = self.state.take_token(self.bucket_key, self.rate, self.capacity, needed)
+                        if not wait:
+                            break
+                    self.condition.wait(timeout=max(wait, 0.01))
+            finally:
+                self.waiting -= 1
+                if priority == INTERACTIVE:
+                    self.interactive_waiting -= 1
+            waited = time.monotonic() - start
+            self.stats["requests"] += 1
+            self.stats["wait_seconds"] += waited
+        return waited
+
+    def pause(self, seconds):
+        with self.condition:
+            if seconds > self.paused_for():
+                self.state.set(self.pause_key, time.time() + seconds, seconds)
+
+    def metrics(self):
+        with self.condition:
+            bucket = self.state.get(self.bucket_key)
+            tokens = self.capacity
+            if bucket is not None:
+                tokens = min(self.capacity, bucket[0] + max(time.time() - bucket[1], 0) * self.rate)
+            return self.stats | {
+                "wait_seconds": round(self.stats["wait_seconds"], 3),
+                "tokens": round(tokens, 2),
+                "capacity": self.capacity,
+                "rate": self.rate,
+                "saturation": round(1 - tokens / self.capacity, 3),
+                "waiting": self.waiting,
+                "paused_for": round(self.paused_for(), 2)
+            }
+
+
+class RateGovernor:
+    def __init__(self, limits, state=None, max_retries=4, base_delay=0.5, max_delay=30, max_pause_wait=30):
+        state = state if state is not None else InProcessState()
+        self.buckets = {
+            upstream: TokenBucket(upstream, rate, capacity, state) for upstream, (rate, capacity) in limits.items()
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_pause_wait = max_pause_wait
+
+    def call(self, upstream, func, *args, **kwargs):
+        # blocking, run it from a worker thread rather than on the event loop
+        bucket = self.buckets[upstream]
+        priority = traffic_priority.get()
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire(priority, self.max_pause_wait)
+            try:
+                return func(*args, **kwargs)
+            except Throttled as e:
+                with bucket.condition:
+                    bucket.stats["throttled"] += 1
+                if attempt == self.max_retries:
+                    with bucket.condition:
+                        bucket.stats["failures"] += 1
+                    raise
+                # full jitter, so callers throttled together don't retry together
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if e.retry_after is not None:
+                    bucket.pause(e.retry_after)
+                    if e.retry_after > self.max_pause_wait:
+                        with bucket.condition:
+                            bucket.stats["failures"] += 1
+                        raise QuotaExhausted(str(e), e.retry_after) from e
+                    delay = max(delay, e.retry_after)
+                with bucket.condition:
+                    bucket.stats["retries"] += 1
+                print("{} throttled ({}), retrying in {:.1f}s".format(upstream, e, delay))
+                time.sleep(delay)
+
+    def pause(self, upstream, seconds):
+        self.buckets[upstream].pause(seconds)
+
+    def metrics(self):
+        return {upstream: bucket.metrics() for upstream, bucket in self.buckets.items()}
+
+
+def create_governor(state=None):
+    limits = dict(DEFAULT_LIMITS)
+    limits.update({upstream: tuple(limit) for upstream, limit in json.loads(os.getenv("sage_rate_limits", "{}")).items()})
+    return RateGovernor(limits, state)
@@ -1,19 +1,37 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from agents import Agent, Runner, FunctionTool, RunContextWrapper
 import requests
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Optional
 import firebase_admin
 from firebase_admin import credentials, firestore
-import subprocess
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
 from agents.mcp import MCPServerStdioParams, MCPServerStdio
 from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
+from googleapiclient.errors import HttpError
 from fastapi.responses import StreamingResponse
 from openai.types.responses import ResponseTextDeltaEvent
+from collections import OrderedDict
+import hashlib
+import html
+import uuid
+import zlib
+import asyncio
+import sqlite3
+import re
 import os
+from shared_state import LockTimeout, create_state
+from job_queue import JobQueue
+from rate_governor import BATCH, Throttled, create_governor, traffic_priority
+from tool_output import html_to_markdown, rank_passages, render_passages, take_budget
+from sandbox_images import choose_image, preinstalled_libraries
+from stackoverflow_search import ask as ask_stackoverflow
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 API_KEY = os.getenv('api_key')
@@ -40,131 +58,545 @@ firebase_admin.initialize_app(cred)
 
 db = firestore.client()
 
-critique_client = OpenAI()
+# retries are left to the rate governor so throttled calls back off with the rest of the upstream's traffic
+critique_client = OpenAI(max_retries=0)
+
+# caches and locks shared between uvicorn workers, see shared_state.py
+state = create_state()
+
+# outbound rate limits per upstream api, kept in the shared state so they hold across workers, see rate_governor.py
+governor = create_governor(state)
+# a google cse daily quota error stops all searches for this long instead of failing every call
+GOOGLE_QUOTA_PAUSE = 60 * 60
+
+# research cache shared by the StackOverflow/WebSearch tools and the prompt prefetch stage
+RESEARCH_CACHE_TTL = 15 * 60
+MAX_PREFETCH_QUERIES = 3
+# references to running prefetches so they aren't garbage collected before they finish
+prefetch_tasks = set()
+# lookups in flight in this worker, finished results live in the shared state
+research_tasks = {}
+
+# final answers for near-duplicate error prompts, matched by simhash hamming distance
+ANSWER_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_DISTANCE = 3
+SIGNATURE_BITS = 64
+# with a distance of 3 or less at least one of the 4 bands matches exactly, so only those buckets are searched
+SIGNATURE_BANDS = 4
+SIGNATURE_BAND_SIZE = 500
+# the signature is the prompt's error lines plus a few lines of code around the lines they point at, the code
+# is weighted to at most this share of the errors so it only separates otherwise identical errors
+SIGNATURE_CODE_LINES = 2
+SIGNATURE_CODE_SHARE = 0.5
+MAX_SIGNATURE_CODE_WINDOWS = 3
+
+# streamed runs are cancelled when the client disconnects or a newer prompt arrives for the same thread
+RUN_WATCH_INTERVAL = 1
+ACTIVE_RUN_TTL = 30 * 60
+# a newer prompt waits this long for the run it supersedes to save its partial reply, so the thread stays in order
+SUPERSEDE_WAIT = 10
+RUN_SAVED_TTL = 5 * 60
+SANDBOX_TIMEOUT = 4
+
+# token budgets for tool outputs, passages that don't fit are kept for the MoreToolOutput tool
+TOOL_TOKEN_BUDGETS = {
+    "CheckStackOverflow": 2000,
+    "ViewWebsite": 1500,
+    "MoreToolOutput": 1500,
+}
+TOOL_PAGE_TTL = 30 * 60
+
+# batch jobs are queued in sqlite and drained by a bounded pool of workers in each server process
+BATCH_WORKERS = int(os.getenv("sage_batch_workers", "4"))
+BATCH_POLL_INTERVAL = 1
+MAX_BATCH_SIZE = int(os.getenv("sage_max_batch_size", "500"))
+job_queue = JobQueue(os.getenv("sage_job_db", "sage_jobs.db"))
+# under the queue's stale_after, so a stuck job is failed here before another worker can claim it again
+BATCH_JOB_TIMEOUT = job_queue.stale_after - 5 * 60
+batch_workers = []
+
+# message bodies above this size are moved to the content-addressed blob store
+BLOB_THRESHOLD = 2048
+BLOB_CACHE_SIZE = 256
+blob_cache = OrderedDict()
+
+# editor file snapshots keyed by thread, path and content hash
+SNAPSHOT_TTL = 6 * 60 * 60
+
+hunk_header = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+# traceback lines ("ValueError: ...", "requests.exceptions.SSLError: ...") and extension diagnostics
+# ("1. [Error] Line 4: ..."), the colon keeps questions like "Error handling best practices?" out
+traceback_error_line = re.compile(r"^(?:\w+\.)*[A-Z]\w*(?:Error|Exception):.*$")
+error_line_number = re.compile(r"\bline (\d+)", re.I)
+diagnostic_error_line = re.compile(r"^\d+\.\s*\[Error\]\s*Line \d+:\s*(.+)$")
+
+
+def retry_after_seconds(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def web_get(url):
+    response = requests.get(url, timeout=10)
+    if response.status_code == 429:
+        raise Throttled("HTTP 429 from {}".format(url), retry_after_seconds(response.headers.get("Retry-After")))
+    return response
+
+
+def stackexchange_get(url):
+    response = requests.get(url, timeout=10)
+    body = response.json()
+    if "backoff" in body:
+        # stackexchange asks for no further calls to this method for backoff seconds
+        governor.pause("stackexchange", body["backoff"])
+    if response.status_code == 400 and body.get("error_name") == "throttle_violation":
+        raise Throttled(body.get("error_message", "throttle_violation"))
+    return body
+
+
+def execute_google_search(request):
+    try:
+        return request.execute()
+    except HttpError as e:
+        reason = str(e)
+        if "dailyLimitExceeded" in reason or "Quota exceeded" in reason:
+            # longer than the governor waits, so this and later calls fail with QuotaExhausted until it's over
+            raise Throttled(reason, GOOGLE_QUOTA_PAUSE)
+        if e.resp.status == 429 or "rateLimitExceeded" in reason:
+            raise Throttled(reason, retry_after_seconds(e.resp.get("retry-after")))
+        raise
+
+
+def call_openai(func, **kwargs):
+    try:
+        return func(**kwargs)
+    except RateLimitError as e:
+        if e.code == "insufficient_quota":
+            raise
+        raise Throttled(str(e), retry_after_seconds(e.response.headers.get("retry-after")))
+
+
+def throttled_error(service, e):
+    # returned to the model instead of raised, an exception out of a FunctionTool ends the whole run
+    if e.retry_after:
+        return "{} is unavailable for the next {:.0f} seconds: {}".format(service, e.retry_after, e)
+    return "{} is rate limited right now, try again later: {}".format(service, e)
 
 
 def extract_text_from_url(url):
     try:
-        response = requests.get(url, timeout=10)
+        response = governor.call("web", web_get, url)
         response.raise_for_status()
-    except requests.RequestException as e:
+    except (requests.RequestException, Throttled) as e:
         return f"Error fetching URL: {e}"
-    soup = BeautifulSoup(response.text, "html.parser")
-    for tag in soup(["script", "style", "noscript"]):
-        tag.decompose()
-    text = soup.get_text()
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    return "".join(lines)
-
-
-def get_messages(doc_id):
+    return html_to_markdown(response.text)
+
+
+def compress_blob(content):
+    raw = content.encode("utf-8")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "zlib", zlib.compress(raw, 9)
+
+
+def decompress_blob(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this blob")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
+
+
+def cache_blob(digest, content):
+    blob_cache[digest] = content
+    blob_cache.move_to_end(digest)
+    while len(blob_cache) > BLOB_CACHE_SIZE:
+        blob_cache.popitem(last=False)
+
+
+def put_blob(content):
+    digest = content_hash(content)
+    if digest not in blob_cache:
+        blob_ref = db.collection("blobs").document(digest)
+        # same content hashes to the same document, so repeated bodies are only stored once
+        if not blob_ref.get().exists:
+            codec, data = compress_blob(content)
+            blob_ref.set({
+                "codec": codec,
+                "data": data,
+                "size": len(content)
+            })
+    cache_blob(digest, content)
+    return digest
+
+
+def get_blobs(digests):
+    # built from the cache hits and the fetched docs, a long conversation can evict its own blobs from the cache
+    blobs = {}
+    missing = []
+    for digest in set(digests):
+        if digest in blob_cache:
+            blobs[digest] = blob_cache[digest]
+            blob_cache.move_to_end(digest)
+        else:
+            missing.append(digest)
+    if missing:
+        refs = [db.collection("blobs").document(digest) for digest in missing]
+        for doc in db.get_all(refs):
+            blob = doc.to_dict()
+            if blob is None:
+                continue
+            blobs[doc.id] = decompress_blob(blob["codec"], blob["data"])
+            cache_blob(doc.id, blobs[doc.id])
+    return blobs
+
+
+def get_message_refs(doc_id):
     doc_ref = db.collection("conversations").document(doc_id)
     doc = doc_ref.get().to_dict()
     return doc['messages']
 
 
+def get_messages(doc_id):
+    messages = get_message_refs(doc_id)
+    blobs = get_blobs([message["blob"] for message in messages if "blob" in message])
+    resolved = []
+    for message in messages:
+        if "blob" in message:
+            content = blobs.get(message["blob"])
+            if content is None:
+                print("Blob {} missing from conversation {}".format(message["blob"], doc_id))
+                content = "[message unavailable]"
+            resolved.append({
+                "content": content,
+                "role": message["role"]
+            })
+        else:
+            resolved.append(message)
+    return resolved
+
+
 def add_message(doc_id, content, role):
     doc_ref = db.collection("conversations").document(doc_id)
     try:
-        messages = get_messages(doc_id)
+        messages = get_message_refs(doc_id)
     except TypeError:
         doc_ref.set({
             "messages": []
         })
-        messages = get_messages(doc_id)
-    messages.append({
-        "content": content,
-        "role": role
-    })
+        messages = get_message_refs(doc_id)
+    if len(content) > BLOB_THRESHOLD:
+        messages.append({
+            "blob": put_blob(content),
+            "size": len(content),
+            "role": role
+        })
+    else:
+        messages.append({
+            "content": content,
+            "role": role
+        })
 
     doc_ref.set({
         "messages": messages
     })
 
 
-def search(error_message):
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/search/excerpts?order=desc&sort=activity&q={}&site=stackoverflow'.format(
-            error_message
-        )
-    )
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def apply_unified_diff(base, diff):
+    # lines are split on "\n" on both ends, so there is no "no newline at end of file" handling
+    base_lines = base.split("\n")
+    result = []
+    position = 0
+    in_hunk = False
+    for line in diff.split("\n"):
+        header = hunk_header.match(line)
+        if header:
+            in_hunk = True
+            start = int(header.group(1))
+            count = int(header.group(2)) if header.group(2) is not None else 1
+            # a hunk that only adds lines points at the line before the insertion
+            target = start if count == 0 else start - 1
+            if target < position or target > len(base_lines):
+                raise ValueError("Hunk out of order: {}".format(line))
+            result.extend(base_lines[position:target])
+            position = target
+        elif not in_hunk or line == "" or line.startswith("\\"):
+            continue
+        elif line[0] == "+":
+            result.append(line[1:])
+        elif line[0] in " -":
+            if position >= len(base_lines) or base_lines[position] != line[1:]:
+                raise ValueError("Diff does not match snapshot at line {}".format(position + 1))
+            if line[0] == " ":
+                result.append(line[1:])
+            position += 1
+        else:
+            raise ValueError("Malformed diff line: {}".format(line))
+    result.extend(base_lines[position:])
+    return "\n".join(result)
+
+
+def snapshot_key(thread_id, path, digest):
+    return "snapshot:{}:{}:{}".format(thread_id, path, digest)
+
+
+def store_snapshot(thread_id, path, content):
+    digest = content_hash(content)
+    state.set(snapshot_key(thread_id, path, digest), content, SNAPSHOT_TTL)
+    return digest
+
+
+def get_snapshot(thread_id, path, digest):
+    if digest is None:
+        return None
+    return state.get(snapshot_key(thread_id, path, digest))
 
-    results = response.json()
-    results = results["items"]
-    question_info = {"question_ids": [], "total_ans": 0}
-    total_ans = 0
 
-    for post in results:
-        if total_ans >= 5:
+def resolve_editor_file(thread_id, editor_file):
+    # returns the current file text, or None when the client has to resend the full content
+    if editor_file.content is not None:
+        content = editor_file.content
+    elif editor_file.diff is not None:
+        base = get_snapshot(thread_id, editor_file.path, editor_file.base_hash)
+        if base is None:
+            return None
+        try:
+            content = apply_unified_diff(base, editor_file.diff)
+        except ValueError as e:
+            print("Could not apply diff for {}: {}".format(editor_file.path, e))
+            return None
+    else:
+        content = get_snapshot(thread_id, editor_file.path, editor_file.content_hash)
+        if content is None:
+            return None
+    if content_hash(content) != editor_file.content_hash:
+        print("Snapshot hash mismatch for {}".format(editor_file.path))
+        return None
+    store_snapshot(thread_id, editor_file.path, content)
+    return content
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def finish_research(key, task):
+    research_tasks.pop(key, None)
+    if not task.cancelled():
+        task.exception()
+
+
+async def fetch_research(key, func, query, args):
+    result = await asyncio.to_thread(state.get, key)
+    if result is None:
+        result = await asyncio.to_thread(func, query, *args)
+        await asyncio.to_thread(state.set, key, result, RESEARCH_CACHE_TTL)
+    return result
+
+
+async def shared_research(key, func, query, args):
+    # the lock keeps other workers from repeating a lookup that is already running
+    try:
+        async with state.lock(key):
+            return await fetch_research(key, func, query, args)
+    except LockTimeout:
+        # a lookup held up by retries or upstream pauses elsewhere shouldn't fail this tool call
+        print("Timed out waiting for {}, fetching without the lock".format(key))
+        return await fetch_research(key, func, query, args)
+
+
+async def cached_research(kind, query, func, *args):
+    key = "research:{}:{}".format(kind, normalize_query(query))
+    result = await asyncio.to_thread(state.get, key)
+    if result is not None:
+        return result
+    task = research_tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(shared_research(key, func, query, args))
+        research_tasks[key] = task
+        task.add_done_callback(lambda t: finish_research(key, t))
+    # shield so a cancelled tool call doesn't cancel a lookup other callers are waiting on
+    return await asyncio.shield(task)
+
+
+def extract_error_lines(prompt):
+    error_lines = []
+    for line in prompt.splitlines():
+        line = line.strip()
+        diagnostic = diagnostic_error_line.match(line)
+        if diagnostic:
+            line = diagnostic.group(1).strip()
+        elif not traceback_error_line.match(line):
+            continue
+        line = line[:200]
+        if line and line not in error_lines:
+            error_lines.append(line)
+        if len(error_lines) >= MAX_PREFETCH_QUERIES:
             break
-        else:
-            if post["is_answered"]:
-                if post['question_score'] >= 1:
-                    question_info["question_ids"].append({
-                        "id": post["question_id"],
-                        "score": post["score"],
-                        "has_accepted_answer": post["has_accepted_answer"],
-                        "answers": post["answer_count"]
-                    })
-                    total_ans += post["answer_count"]
-    question_info["total_ans"] += total_ans
-    return question_info
-
-
-def post_details(post_id):
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/questions/'
-        '{}?order=desc&sort=activity&site=stackoverflow&filter=withbody'.format(post_id)
-    )
+    return error_lines
+
 
-    questions = response.json()
-    question = questions["items"][0]
-    question_title = question["title"]
-    question_body = question["body"]
-    details = {
-        "question_title": question_title,
-        "question_body": question_body,
-        "answers": []
+async def prefetch_query(query):
+    try:
+        await asyncio.gather(
+            cached_research("stackoverflow", query, ask),
+            cached_research("websearch", query, google_search, 10)
+        )
+    except Exception as e:
+        print("Prefetch failed for {}: {}".format(query, e))
+
+
+def prefetch_research(prompt):
+    error_lines = extract_error_lines(prompt)
+    for error_line in error_lines:
+        print("Prefetching research for: {}".format(error_line))
+        task = asyncio.ensure_future(prefetch_query(error_line))
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+    return error_lines
+
+
+def prefetch_note(error_lines):
+    # the cache is keyed by the exact query, so the model is told which ones are already warm
+    queries = "\n".join("- {}".format(error_line) for error_line in error_lines)
+    return "Research for these errors is already being fetched. Pass them exactly as written as the given_error" \
+           " of CheckStackOverflow or the web_query of WebSearch to get the results instantly:\n{}".format(queries)
+
+
+def user_query(ctx):
+    # the runs pass the user's prompt as context so tool outputs can be ranked against it
+    return ctx.context.get("query", "") if isinstance(ctx.context, dict) else ""
+
+
+def compress_tool_output(ctx, tool_name, sections, tool_query):
+    ranked = rank_passages(sections, "{} {}".format(tool_query, user_query(ctx)))
+    selected, remaining = take_budget(ranked, TOOL_TOKEN_BUDGETS[tool_name])
+    page_token = None
+    if remaining:
+        page_token = uuid.uuid4().hex[:16]
+        state.set("tool_page:{}".format(page_token), remaining, TOOL_PAGE_TTL)
+    return {
+        "content": render_passages(selected),
+        "more_passages": len(remaining),
+        "page_token": page_token
     }
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/questions/'
-        '{}/answers?order=desc&sort=votes&site=stackoverflow&filter=withbody'.format(post_id)
-    )
-    answer = response.json()
-    answer = answer["items"]
-    total_score = 0
-    for ans in answer:
-        if ans["is_accepted"]:
-            details["answers"].append({
-                "body": ans['body'],
-                "is_accepted": "True",
-                "score": ans['score']
-            })
-            break
-        elif ans['score'] >= 1:
-            details["answers"].append({
-                "body": ans['body'],
-                "is_accepted": "False",
-                "score": ans['score']
-            })
-            total_score += ans['score']
-            if total_score >= 10:
-                break
-        else:
-            break
-    return details
+
+
+def stackoverflow_sections(answers):
+    sections = []
+    for details, post_id in zip(answers[:-1], answers[-1]):
+        title = html.unescape(details["question_title"])
+        sections.append(("Question {}: {}".format(post_id, title), html_to_markdown(details["question_body"])))
+        for answer in details["answers"]:
+            accepted = "accepted, " if answer["is_accepted"] == "True" else ""
+            label = "Answer to question {} ({}score {})".format(post_id, accepted, answer["score"])
+            sections.append((label, html_to_markdown(answer["body"])))
+    return sections
+
+
+def increment_metric(name, amount=1):
+    return state.incr("metrics:{}".format(name), amount)
+
+
+def signature_tokens(text):
+    text = text.lower()
+    # drop the parts that change between otherwise identical errors: addresses, paths and numbers
+    text = re.sub(r"0x[0-9a-f]+", " ", text)
+    text = re.sub(r"(?:[a-z]:)?[\\/][^\s'\"]+", " ", text)
+    text = re.sub(r"\d+", " ", text)
+    return re.findall(r"[a-z_]+", text)
+
+
+def shingles(tokens):
+    return [" ".join(tokens[i:i + 3]) for i in range(max(len(tokens) - 2, 1))]
+
+
+def simhash(weighted_shingles):
+    weights = [0.0] * SIGNATURE_BITS
+    for shingle, weight in weighted_shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIGNATURE_BITS):
+            weights[bit] += weight if value >> bit & 1 else -weight
+    return sum(1 << bit for bit in range(SIGNATURE_BITS) if weights[bit] > 0)
+
+
+def error_code_window(prompt, file_content):
+    # the code around the lines the traceback or diagnostics point at, not the whole file
+    if not file_content:
+        return ""
+    lines = file_content.splitlines()
+    window = []
+    for number in list(dict.fromkeys(int(n) for n in error_line_number.findall(prompt)))[:MAX_SIGNATURE_CODE_WINDOWS]:
+        if 1 <= number <= len(lines):
+            window.extend(lines[max(number - 1 - SIGNATURE_CODE_LINES, 0):number + SIGNATURE_CODE_LINES])
+    return "\n".join(window)
+
+
+def answer_signature(prompt, file_content):
+    # only prompts carrying errors are cached, so small talk never matches an unrelated answer
+    error_lines = extract_error_lines(prompt)
+    if not error_lines:
+        return None
+    error_shingles = shingles(signature_tokens("\n".join(error_lines)))
+    weighted = [(shingle, 1.0) for shingle in error_shingles]
+    code_tokens = signature_tokens(error_code_window(prompt, file_content))
+    if code_tokens:
+        code_shingles = shingles(code_tokens)
+        code_weight = SIGNATURE_CODE_SHARE * len(error_shingles) / len(code_shingles)
+        weighted.extend((shingle, code_weight) for shingle in code_shingles)
+    return simhash(weighted)
+
+
+def signature_bands(signature):
+    band_bits = SIGNATURE_BITS // SIGNATURE_BANDS
+    mask = (1 << band_bits) - 1
+    return ["answer_band:{}:{}".format(band, signature >> (band * band_bits) & mask) for band in range(SIGNATURE_BANDS)]
+
+
+def lookup_answer(signature):
+    candidates = set()
+    for band_key in signature_bands(signature):
+        candidates.update(state.get(band_key) or [])
+    best = None
+    for candidate in candidates:
+        distance = bin(candidate ^ signature).count("1")
+        if distance <= ANSWER_CACHE_DISTANCE and (best is None or distance < best[0]):
+            cached = state.get("answer:{}".format(candidate))
+            if cached is not None:
+                best = (distance, cached)
+    return best
+
+
+def add_to_band(band_key, signature):
+    bucket = [s for s in state.get(band_key) or [] if s != signature]
+    bucket.append(signature)
+    state.set(band_key, bucket[-SIGNATURE_BAND_SIZE:], ANSWER_CACHE_TTL)
+
+
+async def store_answer(signature, answer):
+    await asyncio.to_thread(state.set, "answer:{}".format(signature), answer, ANSWER_CACHE_TTL)
+    for band_key in signature_bands(signature):
+        try:
+            async with state.lock(band_key):
+                await asyncio.to_thread(add_to_band, band_key, signature)
+        except LockTimeout:
+            # the answer is still stored, it's just not findable through this band
+            print("Timed out waiting for {}, skipping it".format(band_key))
+
+
+def stackexchange_call(url):
+    return governor.call("stackexchange", stackexchange_get, url)
 
 
 def ask(question):
-    details = search(question)
-    post_ids = []
-    for detail in details["question_ids"]:
-        post_ids.append(detail["id"])
-    answers = []
-    for post_id in post_ids:
-        answers.append(post_details(post_id))
-    answers.append(post_ids)
-    return answers
+    return ask_stackoverflow(question, stackexchange_call)
 
 
 class SelfCritiqueArgs(BaseModel):
@@ -184,12 +616,11 @@ class SelfCritiqueScore(BaseModel):
     feedback: str
 
 
-async def self_critique(ctx: RunContextWrapper[Any], args: str) -> dict:
-    global evaluator_mode
-    print("Self Critique Running")
-    parsed = SelfCritiqueArgs.model_validate_json(args)
-    print(f"Question: {parsed.question}\nQuestion Context: {parsed.context}\nQuestion Response: {parsed.answer}")
-    response = critique_client.responses.parse(
+def critique_response(parsed):
+    return governor.call(
+        "openai",
+        call_openai,
+        critique_client.responses.parse,
         model="gpt-5-mini",
         input=[
             {
@@ -233,6 +664,18 @@ async def self_critique(ctx: RunContextWrapper[Any], args: str) -> dict:
         text_format=SelfCritiqueScore
     )
 
+
+async def self_critique(ctx: RunContextWrapper[Any], args: str) -> dict:
+    global evaluator_mode
+    print("Self Critique Running")
+    parsed = SelfCritiqueArgs.model_validate_json(args)
+    print(f"Question: {parsed.question}\nQuestion Context: {parsed.context}\nQuestion Response: {parsed.answer}")
+    try:
+        response = await asyncio.to_thread(critique_response, parsed)
+    except Throttled as e:
+        return {"error": throttled_error("Critique", e),
+                "additional_instructions": "Do not call critique again. Return the response as it is"}
+
     score = response.output_parsed.model_dump()
     score_total = 0
     for sub_score in score:
@@ -289,31 +732,53 @@ class RunCodeArgs(BaseModel):
     code_to_run: str
 
 
+async def kill_sandbox(name):
+    process = await asyncio.create_subprocess_exec(
+        "docker", "kill", name,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    await process.wait()
+
+
 async def run_code(ctx: RunContextWrapper[Any], args: str) -> dict:
     print("Running code")
     parsed = RunCodeArgs.model_validate_json(args)
     code = parsed.code_to_run
     print(code)
+    # named so the container itself can be killed, stopping the docker client alone leaves it running
+    name = "sage-sandbox-{}".format(uuid.uuid4().hex[:12])
+    # the image is picked from the snippet's imports, see sandbox_images.py
+    image, missing = await asyncio.to_thread(choose_image, code)
+    print("Sandbox image {}".format(image))
     try:
-        result = subprocess.run(
-            ["docker", "run", "-i", "--rm", "python:3.11-slim", "python", "-c", code],
-            capture_output=True,
-            text=True,
-            timeout=4
+        process = await asyncio.create_subprocess_exec(
+            "docker", "run", "-i", "--rm", "--name", name, image, "python", "-c", code,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
-        print({
-            "output": result.stdout.strip(),
-            "error": result.stderr.strip()
-        })
-        return {
-            "output": result.stdout.strip(),
-            "error": result.stderr.strip()
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=SANDBOX_TIMEOUT)
+        result = {
+            "output": stdout.decode(errors="replace").strip(),
+            "error": stderr.decode(errors="replace").strip(),
+            "image": image
         }
-    except subprocess.TimeoutExpired:
+        if missing:
+            result["missing_libraries"] = missing
+        print(result)
+        return result
+    except asyncio.TimeoutError:
+        await kill_sandbox(name)
         return {
             "output": "",
             "error": "Timed out, possibly due to input() call, infinite loop, or similar bug."
         }
+    except asyncio.CancelledError:
+        print("Sandbox run cancelled, killing {}".format(name))
+        await asyncio.shield(asyncio.to_thread(increment_metric, "cancelled_sandbox_runs"))
+        await asyncio.shield(kill_sandbox(name))
+        raise
     except Exception as e:
         return {
             "output": "",
@@ -334,7 +799,9 @@ test_code = FunctionTool(
                 " example, in a game, with inputs simulate player inputs using a predefined list and go through those"
                 " inputs manually or run the code with hardcoded values. Do not run code containing potential infinite"
                 " loops. Instead, detect them and inform the user about the unsafe logic, specifying where the infinite"
-                " behavior may occur.",
+                " behavior may occur. These libraries are preinstalled and picked from the code's imports: {}. Other"
+                " libraries are not available and are listed in missing_libraries."
+                .format(", ".join(preinstalled_libraries())),
     params_json_schema=schema,  # Use the updated schema
     on_invoke_tool=run_code,
 )
@@ -342,7 +809,11 @@ test_code = FunctionTool(
 
 def google_search(query, num_results):
     service = build("customsearch", "v1", developerKey=API_KEY)
-    res = service.cse().list(q=query, cx=SEARCH_ENGINE_ID, num=num_results).execute()
+    res = governor.call(
+        "google_cse",
+        execute_google_search,
+        service.cse().list(q=query, cx=SEARCH_ENGINE_ID, num=num_results)
+    )
 
     results = []
     for item in res.get("items", []):
@@ -364,10 +835,14 @@ async def web_search(ctx: RunContextWrapper[Any], args: str) -> list:
     print("Websearching")
     parsed = WebSearchArgs.model_validate_json(args)
     query = parsed.web_query
-    results = parsed.num_results
+    results = min(max(parsed.num_results, 1), 10)
     print("Searching for top {} results for query: {}".format(results, query))
-    search_results = google_search(query, 10)
-    return search_results
+    # always fetch 10 so every num_results shares one cached lookup
+    try:
+        search_results = await cached_research("websearch", query, google_search, 10)
+    except Throttled as e:
+        return [{"error": throttled_error("Web search", e)}]
+    return search_results[:results]
 
 
 schema = WebSearchArgs.model_json_schema()
@@ -388,12 +863,12 @@ class ViewWebsiteArgs(BaseModel):
     url: str
 
 
-async def view_website(ctx: RunContextWrapper[Any], args: str) -> str:
+async def view_website(ctx: RunContextWrapper[Any], args: str) -> dict:
     parsed = ViewWebsiteArgs.model_validate_json(args)
     requested_url = parsed.url
     print("Viewing {} using view_website tool".format(requested_url))
-    url_text = extract_text_from_url(requested_url)
-    return url_text
+    url_text = await asyncio.to_thread(extract_text_from_url, requested_url)
+    return await asyncio.to_thread(compress_tool_output, ctx, "ViewWebsite", [(requested_url, url_text)], requested_url)
 
 
 schema = ViewWebsiteArgs.model_json_schema()
@@ -401,8 +876,10 @@ schema["additionalProperties"] = False
 
 view_website_tool = FunctionTool(
     name="ViewWebsite",
-    description="Returns all text on any website based of provided url. Used to view website. Use WebSearch tool to"
-                "search for urls. Pairs well with using the WebSearch tool.",
+    description="Returns the text of any website based of provided url as markdown, keeping the passages most relevant"
+                " to the question. If more_passages is above 0, pass page_token to MoreToolOutput to read the rest."
+                " Used to view website. Use WebSearch tool to search for urls. Pairs well with using the WebSearch"
+                " tool.",
     params_json_schema=schema,
     on_invoke_tool=view_website,
 )
@@ -412,11 +889,19 @@ class StackOverflowArgs(BaseModel):
     given_error: str
 
 
-async def check_stackoverflow(ctx: RunContextWrapper[Any], args: str) -> list:
+async def check_stackoverflow(ctx: RunContextWrapper[Any], args: str) -> dict:
     print("Checking stackoverflow")
     parsed = StackOverflowArgs.model_validate_json(args)
-    response = ask(parsed.given_error)
+    try:
+        answers = await cached_research("stackoverflow", parsed.given_error, ask)
+    except Throttled as e:
+        return {"content": "", "more_passages": 0, "page_token": None, "post_ids": [],
+                "error": throttled_error("Stack Overflow", e)}
     print(parsed)
+    response = await asyncio.to_thread(
+        compress_tool_output, ctx, "CheckStackOverflow", stackoverflow_sections(answers), parsed.given_error
+    )
+    response["post_ids"] = answers[-1]
     print(response)
     return response
 
@@ -427,12 +912,49 @@ schema["additionalProperties"] = False  # Enforce strict validation
 
 stackoverflow = FunctionTool(
     name="CheckStackOverflow",
-    description="Searches Stack Overflow for relevant answers to the given error message and returns a list of"
-                "structured responses along with corresponding post ids respectively by index.",
+    description="Searches Stack Overflow for relevant answers to the given error message and returns the most"
+                " relevant parts of the questions and answers as markdown along with the post ids. If more_passages"
+                " is above 0, pass page_token to MoreToolOutput to read the rest.",
     params_json_schema=schema,  # Use the updated schema
     on_invoke_tool=check_stackoverflow,
 )
 
+
+class MoreToolOutputArgs(BaseModel):
+    page_token: str
+
+
+async def more_tool_output(ctx: RunContextWrapper[Any], args: str) -> dict:
+    parsed = MoreToolOutputArgs.model_validate_json(args)
+    print("Paging tool output {}".format(parsed.page_token))
+    key = "tool_page:{}".format(parsed.page_token)
+    remaining = await asyncio.to_thread(state.get, key)
+    if remaining is None:
+        return {"content": "", "more_passages": 0, "page_token": None, "error": "Unknown or expired page_token"}
+    selected, remaining = take_budget(remaining, TOOL_TOKEN_BUDGETS["MoreToolOutput"])
+    if remaining:
+        await asyncio.to_thread(state.set, key, remaining, TOOL_PAGE_TTL)
+    else:
+        await asyncio.to_thread(state.delete, key)
+    return {
+        "content": render_passages(selected),
+        "more_passages": len(remaining),
+        "page_token": parsed.page_token if remaining else None
+    }
+
+
+schema = MoreToolOutputArgs.model_json_schema()
+schema["additionalProperties"] = False
+
+more_tool_output_tool = FunctionTool(
+    name="MoreToolOutput",
+    description="Returns the next most relevant passages of an earlier CheckStackOverflow or ViewWebsite result that"
+                " was cut to fit. Pass the page_token from that result. Only use it when the passages already"
+                " returned are not enough.",
+    params_json_schema=schema,
+    on_invoke_tool=more_tool_output,
+)
+
 # Agent
 agent = Agent(
     name="Sage",
@@ -458,7 +980,8 @@ agent = Agent(
         test_code,
         self_critique_tool,
         websearch,
-        view_website_tool
+        view_website_tool,
+        more_tool_output_tool
     ],
     mcp_servers=[
         github_mcp
@@ -485,9 +1008,77 @@ app.add_middleware(
 )
 
 
+system_instructions = " System Instructions: Call your critique tool before returning any response, and follow all" \
+                      " additional instructions and feedback it provides for next steps. Prioritize user experience" \
+                      " by responding in a warm, friendly, and emotionally intelligent tone. You should act as human" \
+                      " as possible to ensure positive, natural interactions. Your name is Sage, and your goal is to" \
+                      " make users feel heard, supported, and understood in every reply. Keep it relaxed," \
+                      " conversational, colloquial and exciting like you're chatting with a friend who’s looking for" \
+                      " a bit of guidance. Use markdown formatting for lists, code snippets, links, headers, text" \
+                      " formatting, and linebreaks. Always follow additional instructions and feedback."
+
+
+class EditorFile(BaseModel):
+    path: str
+    content_hash: str
+    content: Optional[str] = None
+    base_hash: Optional[str] = None
+    diff: Optional[str] = None
+
+
 class GetResponse(BaseModel):
     prompt: str
     thread_id: str
+    file: Optional[EditorFile] = None
+    # skip the near-duplicate answer cache and always run the agent
+    fresh: bool = False
+
+
+class BatchRequest(BaseModel):
+    prompts: list[str]
+
+
+async def run_batch_job(job_id, prompt):
+    print("Running batch job {}".format(job_id))
+    # tool calls and prefetches started from here inherit the batch priority
+    traffic_priority.set(BATCH)
+    agent_input = prompt + system_instructions
+    warm_queries = prefetch_research(prompt)
+    if warm_queries:
+        agent_input += "\n" + prefetch_note(warm_queries)
+    result = await Runner.run(agent, input=agent_input, context={"query": prompt})
+    await asyncio.to_thread(job_queue.complete, job_id, result.final_output)
+
+
+async def batch_worker():
+    while True:
+        # sqlite calls run in a thread so a locked database doesn't stall the event loop
+        try:
+            claimed = await asyncio.to_thread(job_queue.claim)
+        except sqlite3.OperationalError as e:
+            print("Batch claim failed: {}".format(e))
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            continue
+        if claimed is None:
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            continue
+        job_id, prompt = claimed
+        try:
+            await asyncio.wait_for(run_batch_job(job_id, prompt), BATCH_JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Batch job {} timed out".format(job_id))
+            await fail_batch_job(job_id, "Timed out after {} seconds".format(BATCH_JOB_TIMEOUT))
+        except Exception as e:
+            print("Batch job {} failed: {}".format(job_id, e))
+            await fail_batch_job(job_id, str(e))
+
+
+async def fail_batch_job(job_id, error):
+    try:
+        await asyncio.to_thread(job_queue.fail, job_id, error)
+    except sqlite3.OperationalError as e:
+        # left running, the queue requeues it once it goes stale
+        print("Could not mark batch job {} failed: {}".format(job_id, e))
 
 
 @app.on_event("startup")
@@ -498,6 +1089,20 @@ async def start_mcp():
     print("Connected")
 
 
+@app.on_event("startup")
+async def start_batch_workers():
+    for _ in range(BATCH_WORKERS):
+        batch_workers.append(asyncio.create_task(batch_worker()))
+
+
+@app.on_event("shutdown")
+async def stop_batch_workers():
+    for worker in batch_workers:
+        worker.cancel()
+    await asyncio.gather(*batch_workers, return_exceptions=True)
+    batch_workers.clear()
+
+
 @app.on_event("shutdown")
 async def stop_mcp():
     print("Closing mcp server")
@@ -506,36 +1111,189 @@ async def stop_mcp():
     print("Closed")
 
 
+@app.get("/metrics")
+async def get_metrics():
+    stored = await asyncio.to_thread(state.items, "metrics:")
+    metrics = {key[len("metrics:"):]: value for key, value in stored.items()}
+    # rate limiter buckets are per worker process
+    metrics["upstreams"] = governor.metrics()
+    return metrics
+
+
+@app.post("/batch")
+async def create_batch(data: BatchRequest):
+    if not data.prompts:
+        raise HTTPException(status_code=400, detail="empty_batch")
+    if len(data.prompts) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail="batch_too_large")
+    batch_id, job_ids = await asyncio.to_thread(job_queue.enqueue, data.prompts)
+    return {"batch_id": batch_id, "job_ids": job_ids}
+
+
+@app.get("/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    jobs = await asyncio.to_thread(job_queue.get_batch, batch_id)
+    if not jobs:
+        raise HTTPException(status_code=404, detail="unknown_batch")
+    return {"batch_id": batch_id, "jobs": jobs}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown_job")
+    return job
+
+
+def active_run_key(thread_id):
+    return "active_run:{}".format(thread_id)
+
+
+async def watch_run(request, thread_id, run_id, result):
+    while not result.is_complete:
+        await asyncio.sleep(RUN_WATCH_INTERVAL)
+        if await request.is_disconnected():
+            reason = "disconnected"
+        elif await asyncio.to_thread(state.get, active_run_key(thread_id)) not in (None, run_id):
+            # a missing key (expired or evicted) isn't a newer run, only another run id supersedes this one
+            reason = "superseded"
+        else:
+            continue
+        print("Cancelling run for thread {} ({})".format(thread_id, reason))
+        # cancels the agent run task and with it any tool calls still pending
+        result.cancel()
+        return reason
+    return None
+
+
+def run_saved_key(run_id):
+    return "run_saved:{}".format(run_id)
+
+
+def finish_cancelled_run(thread_id, run_id, buffer, reason):
+    # a superseded run the newer prompt gave up waiting on would land after that prompt, so it's dropped instead
+    if buffer and state.get(run_saved_key(run_id)) != "abandoned":
+        add_message(thread_id, buffer, "assistant")
+    increment_metric("cancelled_runs")
+    increment_metric("cancelled_runs_{}".format(reason))
+
+
+def finish_run(thread_id, run_id):
+    state.set(run_saved_key(run_id), "saved", RUN_SAVED_TTL)
+    if state.get(active_run_key(thread_id)) == run_id:
+        state.delete(active_run_key(thread_id))
+
+
+async def supersede_run(thread_id, run_id):
+    # claims the thread, then waits for the run it replaces to save its reply before the new prompt is added
+    previous = await asyncio.to_thread(state.get, active_run_key(thread_id))
+    await asyncio.to_thread(state.set, active_run_key(thread_id), run_id, ACTIVE_RUN_TTL)
+    if previous is None:
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SUPERSEDE_WAIT
+    while await asyncio.to_thread(state.get, run_saved_key(previous)) is None:
+        if loop.time() > deadline:
+            print("Run {} didn't finish in time, dropping its reply".format(previous))
+            await asyncio.to_thread(state.set, run_saved_key(previous), "abandoned", RUN_SAVED_TTL)
+            return
+        await asyncio.sleep(0.1)
+
+
 @app.post("/get_response")
-async def get_response(data: GetResponse):
+async def get_response(data: GetResponse, request: Request):
     prompt = data.prompt
-    prompt += " System Instructions: Call your critique tool before returning any response, and follow all" \
-              " additional instructions and feedback it provides for next steps. Prioritize user experience by " \
-              "responding in a warm, friendly, and emotionally intelligent tone. You should act as human as possible " \
-              "to ensure positive, natural interactions. Your name is Sage, and your goal is to make users feel " \
-              "heard, supported, and understood in every reply. Keep it relaxed, conversational, colloquial and " \
-              "exciting like you're chatting with a friend who’s looking for a bit of guidance. Use markdown" \
-              " formatting for lists, code snippets, links, headers, text formatting, and linebreaks. Always follow" \
-              "additional instructions and feedback."
+    file_content = None
+    if data.file is not None:
+        file_content = await asyncio.to_thread(resolve_editor_file, data.thread_id, data.file)
+        if file_content is None:
+            raise HTTPException(status_code=409, detail="unknown_snapshot")
+        # the thread only keeps a reference, the file itself is sent to the model once below
+        prompt += "\nActive file: {} (snapshot {})".format(data.file.path, data.file.content_hash[:12])
+    prompt += system_instructions
+    # a newer prompt on the same thread, from any worker, supersedes the run still answering the previous one
+    run_id = uuid.uuid4().hex
+    await supersede_run(data.thread_id, run_id)
     add_message(data.thread_id, prompt, "user")
     print("Getting Messages")
     messages = get_messages(data.thread_id)
+    if file_content is not None:
+        messages.insert(len(messages) - 1, {
+            "content": "Current contents of {}:\n{}".format(data.file.path, file_content),
+            "role": "user"
+        })
+
+    # later turns depend on the thread history, so only opening questions use the answer cache
+    signature = None
+    if not data.fresh and len(messages) == (2 if file_content is not None else 1):
+        signature = answer_signature(data.prompt, file_content)
+    if signature is not None:
+        cached = await asyncio.to_thread(lookup_answer, signature)
+        if cached is not None:
+            distance, answer = cached
+            print("Answer cache hit for thread {} (distance {})".format(data.thread_id, distance))
+            await asyncio.to_thread(increment_metric, "answer_cache_hits")
+            await asyncio.to_thread(add_message, data.thread_id, answer, "assistant")
+            await asyncio.to_thread(finish_run, data.thread_id, run_id)
+
+            async def cached_stream():
+                yield answer
+                yield "[DONE]"
+
+            return StreamingResponse(cached_stream(), media_type="text/event-stream")
+        await asyncio.to_thread(increment_metric, "answer_cache_misses")
+
+    # warm the research cache for any errors in the prompt while the first model call is running
+    warm_queries = prefetch_research(data.prompt)
+    if warm_queries:
+        messages.insert(len(messages) - 1, {
+            "content": prefetch_note(warm_queries),
+            "role": "user"
+        })
     print("Getting Response")
 
     async def event_stream():
         buffer = ""
+        result = None
+        watcher = None
+        saved = False
         try:
-            result = Runner.run_streamed(agent, input=messages)
+            result = Runner.run_streamed(agent, input=messages, context={"query": data.prompt})
+            watcher = asyncio.create_task(watch_run(request, data.thread_id, run_id, result))
 
             async for event in result.stream_events():
                 if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
                     delta = event.data.delta
                     buffer += delta
                     yield delta
+            cancel_reason = watcher.result() if watcher.done() else None
+            if cancel_reason is not None:
+                await asyncio.to_thread(finish_cancelled_run, data.thread_id, run_id, buffer, cancel_reason)
+                saved = True
+                yield "[ERROR]Run cancelled ({})".format(cancel_reason)
+                return
             add_message(data.thread_id, buffer, "assistant")
+            saved = True
+            if signature is not None:
+                await store_answer(signature, buffer)
             yield "[DONE]"
+        except (asyncio.CancelledError, GeneratorExit):
+            # the server dropped the stream because the client went away before the watcher noticed
+            if not saved:
+                await asyncio.shield(
+                    asyncio.to_thread(finish_cancelled_run, data.thread_id, run_id, buffer, "disconnected")
+                )
+            raise
         except Exception as e:
             print(e)
             yield f"[ERROR]{str(e)}"
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            if result is not None and not result.is_complete:
+                result.cancel()
+            # lets a newer prompt waiting in supersede_run add its message
+            await asyncio.shield(asyncio.to_thread(finish_run, data.thread_id, run_id))
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
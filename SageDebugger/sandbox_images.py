@@ -0,0 +1,161 @@
+import subprocess
+import argparse
+import json
+import time
+import ast
+import sys
+import re
+import os
+
+# prebuilt sandbox images for the TestCode tool, so snippets importing common libraries run without installing
+# anything at run time. Images are built offline from a local wheelhouse:
+# python sandbox_images.py download   (once, needs network, pins go in the library specs)
+# python sandbox_images.py build      (offline, pip only sees the wheelhouse)
+# override the image set with sage_sandbox_images=/path/images.json, {"image:tag": ["numpy==1.26.4", ...]}
+
+BASE_IMAGE = "python:3.11-slim"
+WHEELHOUSE = os.getenv("sage_wheelhouse", os.path.join(os.path.dirname(os.path.abspath(__file__)), "wheelhouse"))
+# images built (or removed) while the server runs are picked up after this many seconds
+IMAGE_CHECK_TTL = 60
+
+DEFAULT_IMAGES = {
+    "sage-sandbox:web": ["requests==2.32.3", "beautifulsoup4==4.12.3", "httpx==0.27.2", "pyyaml==6.0.2"],
+    "sage-sandbox:data": ["numpy==1.26.4", "pandas==2.2.3", "scipy==1.14.1", "matplotlib==3.9.2"],
+    "sage-sandbox:full": [
+        "requests==2.32.3", "beautifulsoup4==4.12.3", "httpx==0.27.2", "pyyaml==6.0.2",
+        "numpy==1.26.4", "pandas==2.2.3", "scipy==1.14.1", "matplotlib==3.9.2",
+        "scikit-learn==1.5.2", "pillow==10.4.0", "opencv-python-headless==4.10.0.84"
+    ],
+}
+
+# import names that differ from the distribution name
+IMPORT_PACKAGES = {
+    "bs4": "beautifulsoup4",
+    "cv2": "opencv-python-headless",
+    "sklearn": "scikit-learn",
+    "PIL": "pillow",
+    "yaml": "pyyaml",
+}
+
+requirement_name = re.compile(r"^[A-Za-z0-9_.\-]+")
+import_line = re.compile(r"^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w., ]+))", re.M)
+# (checked at, image names)
+image_check = [0.0, frozenset()]
+
+
+def load_images():
+    path = os.getenv("sage_sandbox_images")
+    if path:
+        with open(path) as f:
+            return json.load(f)
+    return DEFAULT_IMAGES
+
+
+def package_name(requirement):
+    return requirement_name.match(requirement).group(0).lower().replace("_", "-")
+
+
+def preinstalled_libraries():
+    return sorted({package_name(requirement) for image in load_images().values() for requirement in image})
+
+
+def detect_imports(code):
+    modules = set()
+    try:
+        for node in ast.walk(ast.parse(code)):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                modules.add(node.module.split(".")[0])
+    except SyntaxError:
+        # broken snippets still get an image, the run will report the syntax error itself
+        for from_module, imported in import_line.findall(code):
+            names = [from_module] if from_module else imported.split(",")
+            modules.update(name.strip().split(" ")[0].split(".")[0] for name in names if name.strip())
+    return {module for module in modules if module not in sys.stdlib_module_names}
+
+
+def required_packages(code):
+    return {IMPORT_PACKAGES.get(module, module).lower().replace("_", "-") for module in detect_imports(code)}
+
+
+def list_images():
+    try:
+        result = subprocess.run(
+            ["docker", "image", "ls", "--format", "{{.Repository}}:{{.Tag}}"],
+            capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return frozenset()
+    return frozenset(result.stdout.split())
+
+
+def available_images():
+    now = time.monotonic()
+    if now - image_check[0] > IMAGE_CHECK_TTL:
+        image_check[:] = [now, list_images()]
+    return image_check[1]
+
+
+def choose_image(code):
+    # smallest built image that has every third party import, otherwise the one missing the fewest
+    needed = required_packages(code)
+    if not needed:
+        return BASE_IMAGE, []
+    built = available_images()
+    best = None
+    for image, requirements in load_images().items():
+        if image not in built:
+            continue
+        missing = sorted(needed - {package_name(requirement) for requirement in requirements})
+        rank = (len(missing), len(requirements))
+        if best is None or rank < best[0]:
+            best = (rank, image, missing)
+    if best is None:
+        return BASE_IMAGE, sorted(needed)
+    return best[1], best[2]
+
+
+def dockerfile(requirements):
+    lines = ["FROM {}".format(BASE_IMAGE)]
+    if requirements:
+        # bind mounted (buildkit) so the wheels never end up in an image layer
+        lines.append("RUN --mount=type=bind,source=.,target=/wheels pip install --no-cache-dir --no-index "
+                     "--find-links /wheels {}".format(" ".join(requirements)))
+    return "\n".join(lines) + "\n"
+
+
+def download(images, platform=None):
+    os.makedirs(WHEELHOUSE, exist_ok=True)
+    requirements = sorted({requirement for image in images.values() for requirement in image})
+    command = [sys.executable, "-m", "pip", "download", "--dest", WHEELHOUSE, "--only-binary=:all:",
+               "--python-version", "3.11"]
+    if platform:
+        command += ["--platform", platform]
+    subprocess.run(command + requirements, check=True)
+
+
+def build(images):
+    for image, requirements in images.items():
+        print("Building {} with {}".format(image, ", ".join(requirements) or "no libraries"))
+        # the wheelhouse is the build context and pip can't reach an index, so builds are offline and repeatable
+        subprocess.run(
+            ["docker", "build", "--network", "none", "-t", image, "-f", "-", WHEELHOUSE],
+            input=dockerfile(requirements), text=True, check=True
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the prebuilt sandbox images from a local wheelhouse")
+    parser.add_argument("command", choices=["download", "build"])
+    parser.add_argument("--platform", help="wheel platform for download, e.g. manylinux2014_x86_64")
+    args = parser.parse_args()
+    images = load_images()
+    if args.command == "download":
+        download(images, args.platform)
+    else:
+        build(images)
+
+
+if __name__ == "__main__":
+    main()
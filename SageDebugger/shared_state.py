@@ -0,0 +1,236 @@
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# shared state for caches and locks, in-process for a single worker or sqlite for multiple workers/replicas
+# sage_state_backend=sqlite sage_state_path=/var/lib/sage/state.db uvicorn sage_server:app --workers 8
+# get/set/delete/incr/items block on sqlite, call them from worker threads (asyncio.to_thread) in async code
+
+
+class LockTimeout(asyncio.TimeoutError):
+    pass
+
+
+class InProcessState:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.values = {}
+        # counters (metrics, rate buckets) live outside values so evicting old cache entries never resets them
+        self.counters = {}
+        self.locks = {}
+        # the methods are called from worker threads as well as the event loop
+        self.mutex = threading.RLock()
+
+    def get(self, key):
+        with self.mutex:
+            if key in self.counters:
+                return self.counters[key]
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.mutex:
+            self.values.pop(key, None)
+            self.values[key] = (value, time.time() + ttl if ttl is not None else None)
+            if len(self.values) > self.max_entries:
+                now = time.time()
+                for expired in [k for k, (_, expires) in self.values.items() if expires is not None and expires < now]:
+                    del self.values[expired]
+                # dicts keep insertion order, so this drops the oldest writes first
+                while len(self.values) > self.max_entries:
+                    del self.values[next(iter(self.values))]
+
+    def delete(self, key):
+        with self.mutex:
+            self.values.pop(key, None)
+            self.counters.pop(key, None)
+
+    def incr(self, key, amount=1):
+        with self.mutex:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            return self.counters[key]
+
+    def items(self, prefix):
+        with self.mutex:
+            values = {key: self.get(key) for key in list(self.values)
+                      if key.startswith(prefix) and self.get(key) is not None}
+            return values | {key: value for key, value in self.counters.items() if key.startswith(prefix)}
+
+    def take_token(self, key, rate, capacity, needed):
+        with self.mutex:
+            tokens, wait = refill_bucket(self.counters.get(key), rate, capacity, needed)
+            self.counters[key] = [tokens, time.time()]
+            return wait
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name, timeout=30):
+        # [lock, holders and waiters], dropped once nobody needs it so one off names don't pile up
+        entry = self.locks.setdefault(name, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise LockTimeout("Timed out waiting for lock {}".format(name)) from None
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self.locks.get(name) is entry:
+                del self.locks[name]
+
+
+class SQLiteState:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+        connection.commit()
+
+    def connection(self):
+        # sqlite connections can't be shared between threads, and tools run in worker threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self.connection().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires >= ?)", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key, value, ttl=None):
+        connection = self.connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl is not None else None)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            connection.execute("DELETE FROM kv WHERE expires < ?", (time.time(),))
+        connection.commit()
+
+    def delete(self, key):
+        connection = self.connection()
+        connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+        connection.commit()
+
+    def incr(self, key, amount=1):
+        # a single upsert, so counters stay correct with several workers writing at once
+        connection = self.connection()
+        row = connection.execute(
+            "INSERT INTO kv (key, value, expires) VALUES (?, ?, NULL) "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS NUMERIC) + excluded.value RETURNING value",
+            (key, json.dumps(amount))
+        ).fetchone()
+        connection.commit()
+        return json.loads(row[0])
+
+    def items(self, prefix):
+        rows = self.connection().execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? AND (expires IS NULL OR expires >= ?)",
+            (prefix, prefix + "\uffff", time.time())
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def take_token(self, key, rate, capacity, needed):
+        # one write transaction, so two workers can't both take the last token
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            tokens, wait = refill_bucket(json.loads(row[0]) if row is not None else None, rate, capacity, needed)
+            connection.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, NULL)",
+                (key, json.dumps([tokens, time.time()]))
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return wait
+
+    def try_lock(self, name, owner, lease):
+        connection = self.connection()
+        now = time.time()
+        connection.execute("DELETE FROM locks WHERE name = ? AND expires < ?", (name, now))
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + lease)
+        )
+        connection.commit()
+        return cursor.rowcount == 1
+
+    def renew_lock(self, name, owner, lease):
+        connection = self.connection()
+        connection.execute(
+            "UPDATE locks SET expires = ? WHERE name = ? AND owner = ?", (time.time() + lease, name, owner)
+        )
+        connection.commit()
+
+    def unlock(self, name, owner):
+        connection = self.connection()
+        connection.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+        connection.commit()
+
+    async def keep_lock(self, name, owner, lease):
+        # renewed while the holder runs, so a lookup slowed by retries and upstream pauses keeps its lock
+        while True:
+            await asyncio.sleep(lease / 3)
+            try:
+                await asyncio.to_thread(self.renew_lock, name, owner, lease)
+            except sqlite3.OperationalError as e:
+                print("Could not renew lock {}: {}".format(name, e))
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name, timeout=30, lease=60):
+        # the lease frees the lock if the worker holding it dies
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not await asyncio.to_thread(self.try_lock, name, owner, lease):
+            if time.monotonic() > deadline:
+                raise LockTimeout("Timed out waiting for lock {}".format(name))
+            await asyncio.sleep(0.05)
+        renewal = asyncio.ensure_future(self.keep_lock(name, owner, lease))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await asyncio.to_thread(self.unlock, name, owner)
+
+
+def refill_bucket(bucket, rate, capacity, needed):
+    # bucket is [tokens, updated] or None for a full one, returns the tokens left and 0 or the seconds to wait
+    now = time.time()
+    tokens, updated = bucket if bucket is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= needed:
+        return tokens - 1, 0.0
+    return tokens, (needed - tokens) / rate
+
+
+def create_state():
+    backend = os.getenv("sage_state_backend", "memory")
+    if backend == "sqlite":
+        return SQLiteState(os.getenv("sage_state_path", "sage_state.db"))
+    if backend == "memory":
+        return InProcessState()
+    raise ValueError("Unknown state backend: {}".format(backend))
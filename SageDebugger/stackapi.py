@@ -1,101 +1,214 @@
+from bs4 import BeautifulSoup
+import argparse
 import requests
+import gzip
+import json
+import time
+import os
+from stackoverflow_search import ask
 
-# stack overflow search algorithim code
-# specific query
-sample_q1 = "urllib3 v2.0 only supports OpenSSL 1.1.1+, currently the 'ssl' module is compiled with LibreSSL 2.8.3"
-# semi-specific query
-sample_q2 = "openai python chatcompletion object is not subscriptable"
-# broad query
-sample_q3 = "openai key not working"
-
-
-def search(error_message):
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/search/excerpts?order=desc&sort=activity&q={}&site=stackoverflow'.format(
-            error_message
-        )
-    )
-
-    if response.status_code != 200:
-        print("Error fetching Stack Overflow results!")
-
-    results = response.json()
-    results = results["items"]
-    question_info = {"question_ids": [], "total_ans": 0}
-    total_ans = 0
-
-    for post in results:
-        if total_ans >= 5:
-            break
+# benchmark for the server's stack overflow search (stackoverflow_search.py)
+# record fixtures once against the live api, then compare changes to search/post_details offline:
+# python stackapi.py --record   (adds to the existing fixtures, rerun after changing the queries or the search)
+# python stackapi.py
+# replayed wall times leave out the network, compare requests and bytes for fetch cost and --live for latency
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stackapi_fixtures.json.gz")
+
+# labelled query set, an answer counts as relevant if it mentions any of the expected terms
+# terms are taken from the known fixes, words any answer on the topic would use don't count
+QUERIES = [
+    {
+        "query": "urllib3 v2.0 only supports OpenSSL 1.1.1+, currently the 'ssl' module is compiled with LibreSSL 2.8.3",
+        "kind": "specific",
+        "expected_terms": ["urllib3==1.26", "urllib3<2", "urllib3 1.26", "openssl@1.1"]
+    },
+    {
+        "query": "ModuleNotFoundError: No module named 'cv2'",
+        "kind": "specific",
+        "expected_terms": ["opencv-python", "pip install opencv"]
+    },
+    {
+        "query": "RuntimeError: dictionary changed size during iteration",
+        "kind": "specific",
+        "expected_terms": ["list(", ".copy()", "copy of"]
+    },
+    {
+        "query": "ImportError: attempted relative import with no known parent package",
+        "kind": "specific",
+        "expected_terms": ["python -m", "python3 -m", "__init__.py"]
+    },
+    {
+        "query": "TypeError: 'NoneType' object is not subscriptable",
+        "kind": "specific",
+        "expected_terms": ["returns none", "in-place", "inplace", "is not none"]
+    },
+    {
+        "query": "openai python chatcompletion object is not subscriptable",
+        "kind": "semi-specific",
+        "expected_terms": [".choices[0].message.content", "choices[0].message", "model_dump"]
+    },
+    {
+        "query": "pandas SettingWithCopyWarning",
+        "kind": "semi-specific",
+        "expected_terms": [".loc", ".copy()", "chained assignment"]
+    },
+    {
+        "query": "UnicodeDecodeError utf-8 codec can't decode byte",
+        "kind": "semi-specific",
+        "expected_terms": ["encoding=", "latin-1", "latin1", "errors="]
+    },
+    {
+        "query": "numpy setting an array element with a sequence",
+        "kind": "semi-specific",
+        "expected_terms": ["dtype=object", "same length", "inhomogeneous", "ragged"]
+    },
+    {
+        "query": "openai key not working",
+        "kind": "broad",
+        "expected_terms": ["api_key", "openai_api_key", "environment variable"]
+    },
+    {
+        "query": "python requests ssl certificate verify failed",
+        "kind": "broad",
+        "expected_terms": ["certifi", "verify=", "install certificates.command", "requests_ca_bundle"]
+    },
+    {
+        "query": "flask app not reloading",
+        "kind": "broad",
+        "expected_terms": ["debug=true", "flask_debug", "--reload", "--debug"]
+    },
+]
+
+
+class MissingFixture(Exception):
+    pass
+
+
+class RecordingHttp:
+    # getter for the search, counts requests and bytes and either records responses to fixtures or replays them
+    def __init__(self, mode, fixtures):
+        self.mode = mode
+        self.fixtures = fixtures
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        self.requests += 1
+        if self.mode == "replay":
+            if url not in self.fixtures:
+                raise MissingFixture("No fixture for {}, record it with --record".format(url))
+            recorded = self.fixtures[url]
+            body = recorded["body"].encode("utf-8")
+            status = recorded["status"]
         else:
-            if post["is_answered"]:
-                if post['question_score'] >= 1:
-                    question_info["question_ids"].append({
-                        "id": post["question_id"],
-                        "score": post["score"],
-                        "has_accepted_answer": post["has_accepted_answer"],
-                        "answers": post["answer_count"]
-                    })
-                    total_ans += post["answer_count"]
-    question_info["total_ans"] += total_ans
-    return question_info
-
-
-def post_details(post_id):
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/questions/{}?order=desc&sort=activity&site=stackoverflow&filter=withbody'
-        .format(post_id)
-    )
-
-    questions = response.json()
-    question = questions["items"][0]
-    question_title = question["title"]
-    question_body = question["body"]
-    details = {
-        "question_title": question_title,
-        "question_body": question_body,
-        "answers": []
+            response = requests.get(url, timeout=10)
+            body = response.content
+            status = response.status_code
+            if self.mode == "record":
+                self.fixtures[url] = {"status": status, "body": body.decode("utf-8")}
+        self.bytes += len(body)
+        if status != 200:
+            print("HTTP {} from {}".format(status, url))
+        return json.loads(body)
+
+
+def is_relevant(details, expected_terms):
+    text = " ".join(BeautifulSoup(answer["body"], "html.parser").get_text() for answer in details["answers"]).lower()
+    return any(term in text for term in expected_terms)
+
+
+def score_query(answers, expected_terms):
+    posts = answers[:-1]
+    relevant = [is_relevant(details, expected_terms) for details in posts]
+    first = relevant.index(True) + 1 if True in relevant else None
+    return {
+        "posts": len(posts),
+        "answers": sum(len(details["answers"]) for details in posts),
+        "precision": sum(relevant) / len(posts) if posts else 0.0,
+        "hit": first is not None,
+        "reciprocal_rank": 1 / first if first else 0.0
+    }
+
+
+def load_fixtures(path):
+    if not os.path.exists(path):
+        return {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_fixtures(path, fixtures):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(fixtures, f, sort_keys=True)
+
+
+def run_benchmark(mode, fixtures_path, kinds=None):
+    # recording merges into the existing fixtures, so recording one --kind keeps the others
+    fixtures = load_fixtures(fixtures_path)
+    results = []
+    for labelled in QUERIES:
+        if kinds and labelled["kind"] not in kinds:
+            continue
+        http = RecordingHttp(mode, fixtures)
+        start = time.perf_counter()
+        answers = ask(labelled["query"], http.get)
+        wall_time = time.perf_counter() - start
+        results.append({
+            "query": labelled["query"],
+            "kind": labelled["kind"],
+            "requests": http.requests,
+            "bytes": http.bytes,
+            "wall_time": wall_time
+        } | score_query(answers, labelled["expected_terms"]))
+    if mode == "record":
+        save_fixtures(fixtures_path, fixtures)
+    return results
+
+
+def summarize(results):
+    count = len(results) or 1
+    return {
+        "queries": len(results),
+        "requests": sum(r["requests"] for r in results),
+        "bytes": sum(r["bytes"] for r in results),
+        "wall_time": sum(r["wall_time"] for r in results),
+        "mean_precision": sum(r["precision"] for r in results) / count,
+        "hit_rate": sum(r["hit"] for r in results) / count,
+        "mrr": sum(r["reciprocal_rank"] for r in results) / count
     }
-    response = requests.get(
-        'https://api.stackexchange.com/2.3/questions/{}/answers?order=desc&sort=votes&site=stackoverflow&filter=withbody'
-        .format(post_id)
-    )
-    answer = response.json()
-    answer = answer["items"]
-    total_score = 0
-    for ans in answer:
-        if ans["is_accepted"]:
-            details["answers"].append({
-                "body": ans['body'],
-                "is_accepted": "True",
-                "score": ans['score']
-            })
-            break
-        elif ans['score'] >= 1:
-            details["answers"].append({
-                "body": ans['body'],
-                "is_accepted": "False",
-                "score": ans['score']
-            })
-            total_score += ans['score']
-            if total_score >= 10:
-                break
-        else:
-            break
-    return details
 
 
-def ask(question):
-    details = search(question)
-    post_ids = []
-    for detail in details["question_ids"]:
-        post_ids.append(detail["id"])
-    answers = []
-    for post_id in post_ids:
-        answers.append(post_details(post_id))
-    answers.append(post_ids)
-    return answers
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Stack Overflow retrieval speed and relevance")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", action="store_true", help="query the live api and save fixtures")
+    mode.add_argument("--live", action="store_true", help="query the live api without saving fixtures")
+    parser.add_argument("--fixtures", default=FIXTURES_PATH)
+    parser.add_argument("--kind", action="append", choices=["specific", "semi-specific", "broad"])
+    parser.add_argument("--json", help="also write per query results and the summary to this file")
+    args = parser.parse_args()
 
+    mode = "record" if args.record else "live" if args.live else "replay"
+    if mode == "replay" and not os.path.exists(args.fixtures):
+        parser.exit(1, "No fixtures at {}, record them once with network access: python stackapi.py --record\n".format(
+            args.fixtures))
+    try:
+        results = run_benchmark(mode, args.fixtures, args.kind)
+    except MissingFixture as e:
+        parser.exit(1, "{}\n".format(e))
+    print("{:<14} {:>4} {:>9} {:>8} {:>5} {:>9} {:>4}  query".format(
+        "kind", "reqs", "bytes", "time", "posts", "precision", "rr"))
+    for r in results:
+        print("{:<14} {:>4} {:>9} {:>7.3f}s {:>5} {:>9.2f} {:>4.2f}  {}".format(
+            r["kind"], r["requests"], r["bytes"], r["wall_time"], r["posts"], r["precision"], r["reciprocal_rank"],
+            r["query"][:60]))
+    summary = summarize(results)
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results, "summary": summary}, f, indent=2)
 
-print(ask(sample_q1))
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# stack overflow search used by the CheckStackOverflow tool and benchmarked by stackapi.py
+# get(url) returns the decoded api response, the server passes its rate limited getter and the benchmark a recorder
+
+
+def search(error_message, get):
+    results = get(
+        'https://api.stackexchange.com/2.3/search/excerpts?order=desc&sort=activity&q={}&site=stackoverflow'.format(
+            error_message
+        )
+    )
+
+    results = results["items"]
+    question_info = {"question_ids": [], "total_ans": 0}
+    total_ans = 0
+
+    for post in results:
+        if total_ans >= 5:
+            break
+        else:
+            if post["is_answered"]:
+                if post['question_score'] >= 1:
+                    question_info["question_ids"].append({
+                        "id": post["question_id"],
+                        "score": post["score"],
+                        "has_accepted_answer": post["has_accepted_answer"],
+                        "answers": post["answer_count"]
+                    })
+                    total_ans += post["answer_count"]
+    question_info["total_ans"] += total_ans
+    return question_info
+
+
+def post_details(post_id, get):
+    questions = get(
+        'https://api.stackexchange.com/2.3/questions/'
+        '{}?order=desc&sort=activity&site=stackoverflow&filter=withbody'.format(post_id)
+    )
+
+    question = questions["items"][0]
+    question_title = question["title"]
+    question_body = question["body"]
+    details = {
+        "question_title": question_title,
+        "question_body": question_body,
+        "answers": []
+    }
+    answer = get(
+        'https://api.stackexchange.com/2.3/questions/'
+        '{}/answers?order=desc&sort=votes&site=stackoverflow&filter=withbody'.format(post_id)
+    )
+    answer = answer["items"]
+    total_score = 0
+    for ans in answer:
+        if ans["is_accepted"]:
+            details["answers"].append({
+                "body": ans['body'],
+                "is_accepted": "True",
+                "score": ans['score']
+            })
+            break
+        elif ans['score'] >= 1:
+            details["answers"].append({
+                "body": ans['body'],
+                "is_accepted": "False",
+                "score": ans['score']
+            })
+            total_score += ans['score']
+            if total_score >= 10:
+                break
+        else:
+            break
+    return details
+
+
+def ask(question, get):
+    details = search(question, get)
+    post_ids = []
+    for detail in details["question_ids"]:
+        post_ids.append(detail["id"])
+    answers = []
+    for post_id in post_ids:
+        answers.append(post_details(post_id, get))
+    answers.append(post_ids)
+    return answers
@@ -0,0 +1,149 @@
+from bs4 import BeautifulSoup
+import math
+import re
+
+# shrinks tool outputs before they reach the model: html to compact markdown, passages ranked against the user's
+# question with bm25, then cut to a token budget. Code blocks are never split.
+
+CHARS_PER_TOKEN = 4
+MAX_PASSAGE_CHARS = 800
+
+code_fence = re.compile(r"(```.*?```)", re.S)
+word = re.compile(r"\w+")
+sentence_end = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def html_to_markdown(html):
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    for pre in soup.find_all("pre"):
+        pre.replace_with("\n\n```\n{}\n```\n\n".format(pre.get_text().strip("\n")))
+    for code in soup.find_all("code"):
+        code.replace_with("`{}`".format(code.get_text()))
+    for link in soup.find_all("a"):
+        text = link.get_text().strip()
+        href = link.get("href")
+        link.replace_with("[{}]({})".format(text, href) if text and href and href.startswith("http") else text)
+    for br in soup.find_all("br"):
+        br.replace_with("\n")
+    for level in range(1, 7):
+        for heading in soup.find_all("h{}".format(level)):
+            heading.insert(0, "#" * level + " ")
+    for item in soup.find_all("li"):
+        item.insert(0, "- ")
+        item.append("\n")
+    for block in soup.find_all(["p", "div", "blockquote", "ul", "ol", "table", "tr", "section", "article",
+                                "h1", "h2", "h3", "h4", "h5", "h6"]):
+        block.append("\n\n")
+    # whitespace is only tidied outside code blocks
+    parts = code_fence.split(soup.get_text())
+    for i in range(0, len(parts), 2):
+        lines = [" ".join(line.split()) for line in parts[i].split("\n")]
+        parts[i] = re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+    return "".join(parts).strip()
+
+
+def split_line(line):
+    # a scraped paragraph is often one long line, cut it at sentence ends, then at spaces, then anywhere
+    if len(line) <= MAX_PASSAGE_CHARS:
+        return [line]
+    pieces = []
+    chunk = ""
+    for sentence in sentence_end.split(line):
+        for part in [sentence] if len(sentence) <= MAX_PASSAGE_CHARS else sentence.split(" "):
+            while len(part) > MAX_PASSAGE_CHARS:
+                if chunk:
+                    pieces.append(chunk)
+                    chunk = ""
+                pieces.append(part[:MAX_PASSAGE_CHARS])
+                part = part[MAX_PASSAGE_CHARS:]
+            if chunk and len(chunk) + 1 + len(part) > MAX_PASSAGE_CHARS:
+                pieces.append(chunk)
+                chunk = ""
+            chunk = chunk + " " + part if chunk else part
+    if chunk:
+        pieces.append(chunk)
+    return pieces
+
+
+def split_passages(text):
+    passages = []
+    for i, part in enumerate(code_fence.split(text)):
+        if i % 2:
+            passages.append(part)
+            continue
+        for paragraph in part.split("\n\n"):
+            paragraph = paragraph.strip()
+            # long paragraphs (common in scraped pages) are cut on line boundaries, long lines by split_line
+            chunk = ""
+            for line in [piece for line in paragraph.split("\n") for piece in split_line(line)]:
+                if chunk and len(chunk) + len(line) > MAX_PASSAGE_CHARS:
+                    passages.append(chunk)
+                    chunk = ""
+                chunk = chunk + "\n" + line if chunk else line
+            if chunk:
+                passages.append(chunk)
+    return passages
+
+
+def bm25_scores(passages, query, k1=1.5, b=0.75):
+    documents = [word.findall(passage.lower()) for passage in passages]
+    terms = set(word.findall(query.lower()))
+    if not documents or not terms:
+        return [0.0] * len(passages)
+    average_length = sum(len(document) for document in documents) / len(documents) or 1
+    frequency = {term: sum(1 for document in documents if term in document) for term in terms}
+    scores = []
+    for document in documents:
+        counts = {}
+        for token in document:
+            if token in terms:
+                counts[token] = counts.get(token, 0) + 1
+        score = 0.0
+        for term, count in counts.items():
+            idf = math.log(1 + (len(documents) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+            score += idf * count * (k1 + 1) / (count + k1 * (1 - b + b * len(document) / average_length))
+        scores.append(score)
+    return scores
+
+
+def rank_passages(sections, query):
+    # sections are (label, text) pairs, passages keep their section label and position
+    passages = []
+    for section_index, (label, text) in enumerate(sections):
+        for passage_index, passage in enumerate(split_passages(text)):
+            passages.append([section_index, passage_index, label, passage])
+    scores = bm25_scores([passage[3] for passage in passages], query)
+    order = sorted(range(len(passages)), key=lambda i: (-scores[i], passages[i][0], passages[i][1]))
+    return [passages[i] for i in order]
+
+
+def take_budget(ranked, budget):
+    selected = []
+    remaining = []
+    used = 0
+    for passage in ranked:
+        cost = estimate_tokens(passage[3])
+        if used + cost <= budget or not selected:
+            selected.append(passage)
+            used += cost
+        else:
+            remaining.append(passage)
+    return selected, remaining
+
+
+def render_passages(selected):
+    # back in document order, so the model reads each source top to bottom
+    output = []
+    current_label = None
+    for _, _, label, passage in sorted(selected, key=lambda p: (p[0], p[1])):
+        if label != current_label:
+            output.append("### {}".format(label))
+            current_label = label
+        output.append(passage)
+    return "\n\n".join(output)
@@ -5,20 +5,48 @@ const vscodeApi = acquireVsCodeApi();
 
 let starterRemoved = false;
 
-function getEditorContext() {
+function getEditorContext(threadId, full = false) {
   return new Promise((resolve) => {
-    vscodeApi.postMessage({ command: 'getContext' });
+    vscodeApi.postMessage({ command: 'getContext', threadId, full });
 
     window.addEventListener('message', function handleMsg(event) {
       const msg = event.data;
       if (msg.type === 'context') {
         window.removeEventListener('message', handleMsg);
-        resolve(msg.data);
+        resolve({ context: msg.data, file: msg.file });
       }
     });
   });
 }
 
+// "/fresh <message>" skips the server's answer cache and runs the agent again
+function parseFresh(text) {
+  const match = text.match(/^\/fresh\b\s*/);
+  return match ? { text: text.slice(match[0].length), fresh: true } : { text, fresh: false };
+}
+
+async function requestResponse(rawText, threadId) {
+  const { text, fresh } = parseFresh(rawText);
+  let { context, file } = await getEditorContext(threadId);
+  let res = await postPrompt(text, context, file, threadId, fresh);
+
+  // server lost the file snapshot (restart, eviction or a failed upload), resend the full file
+  if (res.status === 409) {
+    ({ context, file } = await getEditorContext(threadId, true));
+    res = await postPrompt(text, context, file, threadId, fresh);
+  }
+  return res;
+}
+
+function postPrompt(text, context, file, threadId, fresh = false) {
+  const prompt = `${text}\nContext:\n${context}`;
+  return fetch("http://localhost:8000/get_response", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ prompt, thread_id: threadId, file, fresh }),
+  });
+}
+
 function lockInput(shouldLock) {
   input.disabled = shouldLock;
   sendBtn.disabled = shouldLock;
@@ -139,16 +167,10 @@ async function sendMessage() {
   input.style.height = "auto";
   lockInput(true);
 
-  const context = await getEditorContext();
-  const prompt = `${text}\nContext:\n${context}`;
   const threadId = getThreadId();
 
   try {
-    const res = await fetch("http://localhost:8000/get_response", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ prompt, thread_id: threadId }),
-    });
+    const res = await requestResponse(text, threadId);
 
     if (!res.ok || !res.body) {
       throw new Error("Network error");
@@ -33,11 +33,65 @@ var __importStar = (this && this.__importStar) || (function () {
     };
 })();
 Object.defineProperty(exports, "__esModule", { value: true });
+exports.unifiedDiff = unifiedDiff;
+exports.getFileSnapshot = getFileSnapshot;
 exports.getSessionContext = getSessionContext;
 exports.activate = activate;
 exports.deactivate = deactivate;
 const vscode = __importStar(require("vscode"));
-function getSessionContext() {
+const crypto = __importStar(require("crypto"));
+// last file version sent to the server per thread, so later prompts only send a hash or a diff
+const sentSnapshots = new Map();
+function hashText(text) {
+    return crypto.createHash('sha256').update(text, 'utf8').digest('hex');
+}
+// single hunk unified diff without context lines, split on "\n" to match the server
+function unifiedDiff(oldText, newText) {
+    const a = oldText.split('\n');
+    const b = newText.split('\n');
+    let start = 0;
+    while (start < a.length && start < b.length && a[start] === b[start]) {
+        start++;
+    }
+    let endA = a.length;
+    let endB = b.length;
+    while (endA > start && endB > start && a[endA - 1] === b[endB - 1]) {
+        endA--;
+        endB--;
+    }
+    const removed = a.slice(start, endA);
+    const added = b.slice(start, endB);
+    const oldStart = removed.length ? start + 1 : start;
+    const newStart = added.length ? start + 1 : start;
+    const lines = [`@@ -${oldStart},${removed.length} +${newStart},${added.length} @@`];
+    removed.forEach((line) => lines.push(`-${line}`));
+    added.forEach((line) => lines.push(`+${line}`));
+    return lines.join('\n');
+}
+function getFileSnapshot(threadId, full) {
+    const editor = vscode.window.activeTextEditor;
+    if (!editor) {
+        return undefined;
+    }
+    const path = editor.document.uri.fsPath;
+    const text = editor.document.getText();
+    const hash = hashText(text);
+    const key = `${threadId}::${path}`;
+    const previous = sentSnapshots.get(key);
+    sentSnapshots.set(key, { hash, text });
+    if (full || !previous) {
+        return { path, content_hash: hash, content: text };
+    }
+    if (previous.hash === hash) {
+        return { path, content_hash: hash };
+    }
+    const diff = unifiedDiff(previous.text, text);
+    if (diff.length >= text.length) {
+        return { path, content_hash: hash, content: text };
+    }
+    return { path, content_hash: hash, base_hash: previous.hash, diff };
+}
+function getSessionContext(includeCode = true) {
     const editor = vscode.window.activeTextEditor;
     const terminal = vscode.window.activeTerminal;
     let context = '';
@@ -52,7 +106,9 @@ function getSessionContext() {
         if (selectedText) {
             context += `selection:\n${selectedText}\n\n`;
         }
-        context += `code:\n${fullText}\n`;
+        if (includeCode) {
+            context += `code:\n${fullText}\n`;
+        }
         const diagnostics = vscode.languages.getDiagnostics(doc.uri);
         if (diagnostics.length > 0) {
             context += `\ndiagnostics:\n`;
@@ -91,8 +147,9 @@ class mainViewProvider {
     resolveWebviewView(webviewView, _context, _token) {
         webviewView.webview.onDidReceiveMessage((msg) => {
             if (msg.command === 'getContext') {
-                const payload = getSessionContext();
-                webviewView.webview.postMessage({ type: 'context', data: payload });
+                const file = getFileSnapshot(msg.threadId, !!msg.full);
+                const payload = getSessionContext(!file);
+                webviewView.webview.postMessage({ type: 'context', data: payload, file });
             }
         });
         this._view = webviewView;
@@ -124,7 +181,7 @@ class mainViewProvider {
 				<div class="thread-id" onclick="changeThread()">Thread: #a829X</div>
 				</div>
 				<div id="chat-messages" class="chat-messages">
-				<div class="bot-message starter-message">Hi! I'm Sage — your coding assistant. Ask me anything to get started.</div>
+				<div class="bot-message starter-message">Hi! I'm Sage — your coding assistant. Ask me anything to get started, or start with /fresh to skip cached answers.</div>
 				</div>
 				<div class="chat-input-container">
 				<textarea id="user-input" rows="1" placeholder="Type your message..."></textarea>
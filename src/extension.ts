@@ -1,6 +1,71 @@
 import * as vscode from 'vscode';
+import * as crypto from 'crypto';
+
+export interface FileSnapshot {
+	path: string;
+	content_hash: string;
+	content?: string;
+	base_hash?: string;
+	diff?: string;
+}
+
+// last file version sent to the server per thread, so later prompts only send a hash or a diff
+const sentSnapshots = new Map<string, { hash: string, text: string }>();
+
+function hashText(text: string): string {
+	return crypto.createHash('sha256').update(text, 'utf8').digest('hex');
+}
+
+// single hunk unified diff without context lines, split on "\n" to match the server
+export function unifiedDiff(oldText: string, newText: string): string {
+	const a = oldText.split('\n');
+	const b = newText.split('\n');
+	let start = 0;
+	while (start < a.length && start < b.length && a[start] === b[start]) {
+		start++;
+	}
+	let endA = a.length;
+	let endB = b.length;
+	while (endA > start && endB > start && a[endA - 1] === b[endB - 1]) {
+		endA--;
+		endB--;
+	}
+	const removed = a.slice(start, endA);
+	const added = b.slice(start, endB);
+	const oldStart = removed.length ? start + 1 : start;
+	const newStart = added.length ? start + 1 : start;
+	const lines = [`@@ -${oldStart},${removed.length} +${newStart},${added.length} @@`];
+	removed.forEach((line) => lines.push(`-${line}`));
+	added.forEach((line) => lines.push(`+${line}`));
+	return lines.join('\n');
+}
 
-export function getSessionContext(): string {
+export function getFileSnapshot(threadId: string, full: boolean): FileSnapshot | undefined {
+	const editor = vscode.window.activeTextEditor;
+	if (!editor) {
+		return undefined;
+	}
+	const path = editor.document.uri.fsPath;
+	const text = editor.document.getText();
+	const hash = hashText(text);
+	const key = `${threadId}::${path}`;
+	const previous = sentSnapshots.get(key);
+	sentSnapshots.set(key, { hash, text });
+
+	if (full || !previous) {
+		return { path, content_hash: hash, content: text };
+	}
+	if (previous.hash === hash) {
+		return { path, content_hash: hash };
+	}
+	const diff = unifiedDiff(previous.text, text);
+	if (diff.length >= text.length) {
+		return { path, content_hash: hash, content: text };
+	}
+	return { path, content_hash: hash, base_hash: previous.hash, diff };
+}
+
+export function getSessionContext(includeCode: boolean = true): string {
   const editor = vscode.window.activeTextEditor;
   const terminal = vscode.window.activeTerminal;
   let context = '';
@@ -16,7 +81,9 @@ export function getSessionContext(): string {
 	if (selectedText) {
 		context += `selection:\n${selectedText}\n\n`;
 	}
-	context += `code:\n${fullText}\n`;
+	if (includeCode) {
+		context += `code:\n${fullText}\n`;
+	}
 
 	const diagnostics = vscode.languages.getDiagnostics(doc.uri);
 	if (diagnostics.length > 0) {
@@ -74,8 +141,9 @@ class mainViewProvider implements vscode.WebviewViewProvider {
 	) {
 		webviewView.webview.onDidReceiveMessage((msg) => {
 		if (msg.command === 'getContext') {
-			const payload = getSessionContext();
-			webviewView.webview.postMessage({ type: 'context', data: payload });
+			const file = getFileSnapshot(msg.threadId, !!msg.full);
+			const payload = getSessionContext(!file);
+			webviewView.webview.postMessage({ type: 'context', data: payload, file });
 		}
 		});
 
@@ -110,7 +178,7 @@ class mainViewProvider implements vscode.WebviewViewProvider {
 				<div class="thread-id" onclick="changeThread()">Thread: #a829X</div>
 				</div>
 				<div id="chat-messages" class="chat-messages">
-				<div class="bot-message starter-message">Hi! I'm Sage — your coding assistant. Ask me anything to get started.</div>
+				<div class="bot-message starter-message">Hi! I'm Sage — your coding assistant. Ask me anything to get started, or start with /fresh to skip cached answers.</div>
 				</div>
 				<div class="chat-input-container">
 				<textarea id="user-input" rows="1" placeholder="Type your message..."></textarea>